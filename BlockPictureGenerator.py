@@ -47,7 +47,6 @@ class Block:
     colour: string, a colour from the colour list defined above
     x and y coordinate: ints (with respect to the position in the picture grid, i.e. x=1 and y=1 is the block in the upper left corner)
     shape: string, a shape from the shape list defined above
-    back_track: list, for keeping track of relations between blocks
     """
     def __init__(self, colour, shape):
         """
@@ -58,7 +57,6 @@ class Block:
         self.shape = shape
         self.x = None
         self.y = None
-        self.back_track = []
 
     def set_coordinates(self, x, y):
         """
@@ -77,13 +75,6 @@ class Block:
         s = self.shape + ": " + self.colour
         return s
 
-    def keep_track(self, block):
-        """
-        adds a block to the back_track list
-        :param block: a Block object
-        """
-        self.back_track.append(block)
-
 
 
 class Picture:
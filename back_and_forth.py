@@ -2,22 +2,43 @@
 
 class BackAndForth_Iterator:
     def __init__(self,somelist):
+        # somelist can be a list or any iterable, e.g. the generator returned by Grammar.stream_guesses
+        # the elements of an iterable are only taken from it when they are needed
         self.index = -1
-        self.list = somelist
+        self.list = []
+        self.stream = iter(somelist)
+
+    def fetch(self):
+        # takes the next element from the iterable, returns False if it is exhausted
+        if self.stream is None:
+            return False
+        try:
+            self.list.append(next(self.stream))
+            return True
+        except StopIteration:
+            self.stream = None
+            return False
+
+    def all(self):
+        # takes all remaining elements from the iterable and returns the list of all elements
+        while self.fetch():
+            pass
+        return self.list
 
     def next(self):
-        if self.list == []:
+        if self.list == [] and not self.fetch():
             raise StopIteration
         self.index += 1
-        if self.index >= len(self.list):
+        if self.index >= len(self.list) and not self.fetch():
             self.index = 0
         return self.list[self.index]
 
     def previous(self):
-        if self.list == []:
+        if self.list == [] and not self.fetch():
             raise StopIteration
         self.index -= 1
         if self.index < 0:
+            self.all()
             self.index = len(self.list)-1
         return self.list[self.index]
     
@@ -0,0 +1,193 @@
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import deque
+from floating_grammar import *
+
+"""
+Parses many picture descriptions offline, e.g. to score the descriptions recorded in the sessions again
+parse_batch takes an iterable of (utterance, grid, lexicon) jobs and yields the ranked guess groups of each job, run as
+a script it reads one job per line as JSON from stdin and writes one result per line as JSON to stdout:
+    python batch_parser.py --workers 4 < jobs.jsonl > results.jsonl
+A job line looks like
+    {"utterance": "a red circle", "grid": [[["red", "circle"], null], [null, ["blue", "triangle"]]], "lexicon": {...}}
+where each row of the grid lists the [colour, shape] of the blocks or null for empty positions and the optional lexicon
+maps each word to a list of [category, logical form, weight] lists; without a lexicon every word is mapped to all crude
+lexical rules as when learning from scratch. The logical forms are compiled to Python code, so only the category and
+logical form pairs of the crude lexical rules are accepted in a lexicon
+A result line contains the utterance, the truncated flag of the parse and the groups in the order
+of grouping, each with the [x, y] coordinates of its guessed blocks (x=1 and y=1 is the block in the upper left corner),
+the weight and the formula of its best parse; groups with the same weight are ordered by their coordinates and of the
+best parses with the same weight the one with the first formula is taken, so the results do not depend on the order in
+which the parses were found
+A line that is no valid job and a job whose parse fails yield a result line with the utterance (null if it is not known)
+and the error instead, the other jobs are not affected. Each parse is stopped after job_deadline seconds by default.
+Only a bounded number of jobs is read ahead of the results that have been written, so the input can be arbitrarily large
+"""
+
+# max. number of seconds for the parse of each job by default, as parse_deadline in gui_simple_floating.py
+job_deadline = 60
+
+
+def grid_from_json(rows):
+    """
+    creates the grid of a picture from its JSON representation
+    :param rows: list of rows, each a list of [colour, shape] lists or None for empty positions
+    :return: list of rows of Block objects and None, with the coordinates of the blocks set
+    """
+    grid = [[Block(*cell) if cell else None for cell in row] for row in rows]
+    set_all_coordinates(grid)
+    return grid
+
+
+def lexicon_from_json(lexicon, words):
+    """
+    :param lexicon: None or dictionary mapping words to lists of [category, logical form, weight] lists
+    :param words: list of the tokens of the utterance
+    :return: dictionary mapping each word to a list of (category, logical form, weight) tuples, the words without any
+            entry in lexicon are mapped to all crude lexical rules with weight 0 in sorted order
+    :raise ValueError: if an entry is not a crude lexical rule with a number as weight
+    """
+    crude_rules = sorted(create_lex_rules())
+    known_rules = {(categorie, function) for categorie, function, weight in crude_rules}
+    lexicon_tuples = {}
+    for word in words:
+        if lexicon is not None and word in lexicon:
+            lexicon_tuples[word] = []
+            for entry in lexicon[word]:
+                # the logical forms are compiled with eval (see Grammar.compile), so no other ones are accepted
+                if not isinstance(entry, list) or len(entry) != 3 or tuple(entry[:2]) not in known_rules or \
+                        isinstance(entry[2], bool) or not isinstance(entry[2], (int, float)):
+                    raise ValueError("unknown lexical rule for '" + word + "': " + json.dumps(entry))
+                lexicon_tuples[word].append(tuple(entry))
+        else:
+            lexicon_tuples[word] = crude_rules[:]
+    return lexicon_tuples
+
+
+def error_result(utterance, error):
+    """
+    :param utterance: None or the utterance of the job
+    :param error: the exception raised for the job
+    :return: dictionary with the utterance and the error, the result of a job that could not be parsed
+    """
+    return {"utterance": utterance, "error": type(error).__name__ + ": " + str(error)}
+
+
+def parse_job(job, options):
+    """
+    parses an utterance and groups its parses that evaluate to True w.r.t. the picture by their guessed blocks
+    every job is evaluated in its own EvaluationContext
+    :param job: tuple of the utterance, the grid (list of rows of Block objects and None) and the lexicon (dictionary
+            mapping words to lists of (category, logical form, weight) tuples or None for the crude lexicon)
+    :param options: dictionary with the keyword arguments of Grammar.forest and "groups", None or the max. number of
+            groups
+    :return: dictionary with the utterance, the truncated flag and the groups, see the description of the script at
+            the top, or the result of error_result if the job cannot be parsed
+    """
+    utterance, grid, lexicon = job
+    options = options.copy()
+    k = options.pop("groups", None)
+    # an invalid job must not stop the other jobs, which might be parsed in the same process
+    try:
+        context = EvaluationContext()
+        context.set_grid(grid)
+        gram = Grammar(lexicon_from_json(lexicon, utterance.split()), rules, functions)
+        forest = gram.forest(utterance, context=context, **options)
+        groups = []
+        for guesses in forest.guesses():
+            best, = forest.group(guesses, limit=1)
+            groups.append({"blocks": sorted([b.x, b.y] for b in guesses), "weight": best.summed_weights,
+                           "formula": best.formular})
+    except Exception as error:
+        return error_result(utterance, error)
+    groups.sort(key=lambda group: (-group["weight"], group["blocks"]))
+    return {"utterance": utterance, "truncated": forest.truncated, "groups": groups[:k]}
+
+
+def parse_batch(jobs, workers=None, window=None, **options):
+    """
+    parses the utterances of many jobs, see parse_job, by this process or by a pool of processes
+    the jobs are taken from the iterable only when there are less than window jobs whose results have not been yielded
+    yet, so the jobs and the results are never all held in memory
+    :param jobs: iterable of (utterance, grid, lexicon) tuples, see parse_job, or of exceptions for the jobs that could
+            not be read, see read_jobs
+    :param workers: None or the number of processes, the jobs are parsed by this process if it is None or 1
+    :param window: None or the max. number of jobs that are parsed or waiting to be parsed at the same time, by default
+            4 for each process
+    :param options: keyword arguments of Grammar.forest, e.g. deadline, max_items or max_insertions, and groups, the
+            max. number of groups of each job; the deadline is job_deadline if it is not given, None for no deadline
+    :return: generator of the results of parse_job in the order of the jobs, see error_result for the exceptions
+    """
+    options.setdefault("deadline", job_deadline)
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield error_result(None, job) if isinstance(job, Exception) else parse_job(job, options)
+        return
+    if window is None:
+        window = 4 * workers
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            if isinstance(job, Exception):
+                pending.append(error_result(None, job))
+            else:
+                pending.append(pool.apply_async(parse_job, (job, options)))
+            if len(pending) >= window:
+                yield result_of(pending.popleft())
+        while pending:
+            yield result_of(pending.popleft())
+
+
+def result_of(pending_job):
+    """
+    :param pending_job: the result of a job that could not be read or the AsyncResult of a job given to the pool
+    :return: the result of the job, see parse_batch
+    """
+    if isinstance(pending_job, dict):
+        return pending_job
+    # parse_job returns the errors of the parse as results, this only fails if the process itself fails
+    try:
+        return pending_job.get()
+    except Exception as error:
+        return error_result(None, error)
+
+
+def read_jobs(lines):
+    """
+    :param lines: iterable of JSON lines, see the description of the script at the top
+    :return: generator of the (utterance, grid, lexicon) jobs and of a ValueError with the line number for each line that
+            is no valid job, empty lines are skipped
+    """
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                job = json.loads(line)
+                utterance = job["utterance"]
+                if not isinstance(utterance, str):
+                    raise TypeError("the utterance is no string")
+                yield utterance, grid_from_json(job["grid"]), job.get("lexicon")
+            except Exception as error:
+                yield ValueError("line " + str(number) + ": " + type(error).__name__ + ": " + str(error))
+
+
+if __name__ == "__main__":
+    """
+    reads jobs as JSON lines from stdin and writes the result of each job as a JSON line to stdout
+    """
+    parser = argparse.ArgumentParser(description="parses picture descriptions given as JSON lines")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("--window", type=int, default=None, help="max. number of jobs parsed at the same time")
+    parser.add_argument("--groups", type=int, default=None, help="max. number of guess groups of each description")
+    parser.add_argument("--deadline", type=float, default=job_deadline,
+                        help="max. number of seconds for each parse, 0 for no deadline")
+    parser.add_argument("--max-items", type=int, default=None, help="max. number of ParseItems of each parse")
+    parser.add_argument("--max-insertions", type=int, default=None,
+                        help="max. number of ParseItems built out of the air in one formula")
+    args = parser.parse_args()
+    results = parse_batch(read_jobs(sys.stdin), args.workers, args.window, groups=args.groups,
+                          deadline=args.deadline or None, max_items=args.max_items, max_insertions=args.max_insertions)
+    for result in results:
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,342 @@
+import sys
+import json
+import time
+import random
+import platform
+import tracemalloc
+from floating_grammar import *
+from world import allblocks_test
+from PictureLevel import setPicParameters
+
+"""
+Benchmarks for the floating parser defined in floating_grammar.py
+The utterances are parsed with a crude lexicon as used when learning from scratch, i.e. every word is mapped to all
+lexical rules, and evaluated with respect to the picture defined in world.py
+"""
+
+# utterances of increasing length used by default
+benchmark_utterances = ["a circle", "a red circle", "two red circles", "a red circle over"]
+
+# utterances and numbers of processes used by default for the scaling benchmark of the parallel evaluation
+scaling_utterances = ["a red circle over", "a circle and a square"]
+scaling_workers = [1, 4, 8, 16]
+
+# utterances used by default for the comparison of the parses with and without prune_equivalent
+equivalence_utterances = ["a red circle over", "a circle and a square"]
+
+# utterances used by default for the benchmark of the SubParseMemo, each one is streamed after the utterance without its
+# last token
+memo_utterances = ["a red circle over", "a red circle over a square"]
+
+# utterances of the benchmark suite for each level, following the constraints on the descriptions of the level, from 1
+# to 15 tokens
+suite_utterances = {
+    1: ["circle", "a circle", "two forms"],
+    2: ["a red circle", "two blue forms", "one green triangle"],
+    3: ["a circle under a square", "a circle and a square", "a triangle over a circle and a square"],
+    4: ["a red circle over a blue square", "a red circle over a blue square and a green triangle",
+        "a red circle over a blue square or a green triangle under a yellow circle"]
+}
+# seed of the random pictures of the benchmark suite, the picture of each level is created with seed + level
+suite_seed = 0
+# max. number of ParseItems of each parse of the benchmark suite
+suite_max_items = 50000
+
+
+def crude_lexicon_for(words):
+    """
+    creates a lexicon that maps each of the words to all crude lexical rules with weight 0
+    :param words: list of tokens
+    :return: dictionary mapping each word to a list of (category, logical form, weight) tuples
+    """
+    crude_rules = create_lex_rules()
+    return {word: crude_rules[:] for word in words}
+
+
+def use_world_picture():
+    """
+    sets the blocks of the picture from world.py as the current picture of the grammar
+    :return: None
+    """
+    default_context.set_grid(allblocks_test)
+
+
+def memory_benchmark(utterances):
+    """
+    parses each utterance while tracing all memory allocations
+    :param utterances: list of strings
+    :return: list of dictionaries, one for each utterance, with the number of parses, the peak of the traced memory
+            during the parse and the memory still allocated after the parse in bytes
+    """
+    results = []
+    for utterance in utterances:
+        gram = Grammar(crude_lexicon_for(utterance.split()), rules, functions)
+        tracemalloc.start()
+        parses = gram.gen(utterance)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({"utterance": utterance, "parses": len(parses), "peak": peak, "retained": retained})
+        del parses
+    return results
+
+
+def evaluation_benchmark(utterances, worker_counts):
+    """
+    parses each utterance and evaluates the complete ParseItems serially and with a pool of processes (see
+    Grammar.evaluate_all) for each number of processes
+    :param utterances: list of strings
+    :param worker_counts: list of ints, the numbers of processes, 1 means the serial evaluation
+    :return: list of dictionaries, one for each utterance and number of processes, with the number of parses, the time
+            of the evaluation in seconds, the speedup compared to the serial evaluation and whether the values and guessed
+            blocks equal the serial ones
+    """
+    results = []
+    for utterance in utterances:
+        gram = Grammar(crude_lexicon_for(utterance.split()), rules, functions)
+        chart = defaultdict(dict)
+        for complete_items, bound in gram.derive(utterance, chart, {}):
+            pass
+        items = [item for (c, size), cell in chart.items() if c == "V" for item in cell.values()]
+        serial = None
+        for workers in worker_counts:
+            # every evaluation starts without stored denotations
+            denotations.clear()
+            start = time.time()
+            parses = gram.evaluate_all(items, workers)
+            seconds = time.time() - start
+            if serial is None:
+                serial, serial_time = parses, seconds
+            equal = [(parse.semantic, parse.guessed_blocks) for parse in parses] == \
+                    [(parse.semantic, parse.guessed_blocks) for parse in serial]
+            results.append({"utterance": utterance, "workers": workers, "parses": len(parses), "time": seconds,
+                            "speedup": serial_time / seconds, "equal": equal})
+    return results
+
+
+def equivalence_benchmark(utterances):
+    """
+    parses each utterance with and without prune_equivalent (see Grammar.gen) and compares the formulas of the parses,
+    with prune_equivalent including the formulas kept in the alternatives of the complete ParseItems
+    :param utterances: list of strings
+    :return: list of dictionaries, one for each utterance, with the number of parses and the times of both parses in
+            seconds and whether the formulas built from the same components are equal
+    """
+    results = []
+    for utterance in utterances:
+        gram = Grammar(crude_lexicon_for(utterance.split()), rules, functions)
+        formulas = []
+        for prune_equivalent in (False, True):
+            denotations.clear()
+            start = time.time()
+            parses = gram.gen(utterance, prune_equivalent=prune_equivalent)
+            seconds = time.time() - start
+            formulas.append((sorted((parse.formular, tuple(sorted(parse.components)))
+                                    for item in parses for parse in [item] + list(item.alternatives)),
+                             len(parses), seconds))
+        (plain, plain_parses, plain_time), (pruned, pruned_parses, pruned_time) = formulas
+        results.append({"utterance": utterance, "parses": len(plain), "pruned_parses": pruned_parses,
+                        "time": plain_time, "pruned_time": pruned_time, "equal": plain == pruned})
+    return results
+
+
+def memo_benchmark(utterances):
+    """
+    streams each utterance without its last token with a SubParseMemo, changes the weights of the lexical rules of these
+    tokens as the learning does and streams the utterance with the same SubParseMemo and without a SubParseMemo (see
+    Grammar.stream_guesses with packed)
+    :param utterances: list of strings with at least two tokens
+    :return: list of dictionaries, one for each utterance, with the number of parses, the times of both streams in
+            seconds and whether the weights of the parses and the best weight of each guess equal the ones without the
+            SubParseMemo
+    """
+    results = []
+    for utterance in utterances:
+        words = utterance.split()
+        lexicon = crude_lexicon_for(words)
+        gram = Grammar(lexicon, rules, functions)
+        memo = SubParseMemo()
+        for guess in gram.stream_guesses(" ".join(words[:-1]), ParseResult(), packed=True, memo=memo):
+            pass
+        for word in words[:-1]:
+            lexicon[word] = [(categorie, function, i % 3 - 1) for i, (categorie, function, weight)
+                             in enumerate(lexicon[word])]
+        streamed = []
+        for used_memo in (memo, None):
+            denotations.clear()
+            parses = ParseResult()
+            start = time.time()
+            for guess in gram.stream_guesses(utterance, parses, packed=True, memo=used_memo):
+                pass
+            best = {}
+            for parse in parses:
+                if parse.semantic:
+                    best[parse.guessed_blocks] = max(best.get(parse.guessed_blocks, parse.summed_weights),
+                                                     parse.summed_weights)
+            streamed.append((parses, time.time() - start, sorted(parse.summed_weights for parse in parses), best))
+        (parses, memo_time, memo_weights, memo_best), (fresh, fresh_time, fresh_weights, fresh_best) = streamed
+        results.append({"utterance": utterance, "parses": len(parses), "memo_time": memo_time,
+                        "fresh_time": fresh_time, "equal": memo_weights == fresh_weights and memo_best == fresh_best})
+    return results
+
+
+def percentile(values, p):
+    """
+    :param values: non-empty list of numbers
+    :param p: the percentile, between 0 and 100
+    :return: the smallest value such that at least p percent of the values are not larger (nearest rank)
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def suite_picture(level, seed=suite_seed):
+    """
+    creates the picture of a level for the benchmark suite, the same seed always gives the same picture
+    :param level: int
+    :param seed: int
+    :return: EvaluationContext with the picture
+    """
+    state = random.getstate()
+    random.seed(seed + level)
+    picture = setPicParameters(level, 1, "benchmark")
+    random.setstate(state)
+    return EvaluationContext(picture)
+
+
+def suite_benchmark(utterances=None, repeats=5, max_items=suite_max_items, seed=suite_seed):
+    """
+    parses the utterances of each level (Grammar.gen, including the evaluation of the parses with Grammar.sem) and
+    groups the parses (grouping) w.r.t. a random picture of the level, once with the gold lexicon and once with a crude
+    lexicon as used when learning from scratch
+    each utterance is parsed repeats times to measure the latency and once more while tracing all memory allocations
+    the parses are stopped by max_items rather than by a deadline, so a truncated parse always does the same work and
+    its latency can be compared between runs with the same max_items
+    :param utterances: None for suite_utterances or a dictionary mapping levels to lists of utterances
+    :param repeats: int, the number of timed parses of each utterance
+    :param max_items: None or the max. number of ParseItems of each parse, see Grammar.gen
+    :param seed: int, see suite_picture
+    :return: dictionary with the settings of the run and a list with a dictionary for each level, lexicon and utterance
+            with the number of tokens, parses and groups, whether the parse was truncated, the ParseStats of the last
+            timed parse, the number of ParseItems it created per second of parse time, the percentiles of the latency
+            in seconds and the peak of the traced memory in bytes
+    """
+    if utterances is None:
+        utterances = suite_utterances
+    results = []
+    for level in sorted(utterances):
+        for lexicon_name in ["gold", "crude"]:
+            for utterance in utterances[level]:
+                words = utterance.split()
+                lexicon = gold_lexicon_basic if lexicon_name == "gold" else crude_lexicon_for(words)
+                gram = Grammar(lexicon, rules, functions)
+                latencies = []
+                for repeat in range(repeats):
+                    # every parse is evaluated w.r.t. a new context, i.e. without any stored denotations
+                    context = suite_picture(level, seed)
+                    start = time.perf_counter()
+                    parses = gram.gen(utterance, max_items=max_items, context=context)
+                    groups, sorted_guesses = grouping(parses)
+                    latencies.append(time.perf_counter() - start)
+                context = suite_picture(level, seed)
+                tracemalloc.start()
+                traced_parses = gram.gen(utterance, max_items=max_items, context=context)
+                grouping(traced_parses)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del traced_parses
+                results.append({"level": level, "lexicon": lexicon_name, "utterance": utterance,
+                                "tokens": len(words), "parses": len(parses), "groups": len(sorted_guesses),
+                                "truncated": parses.truncated, "stats": parses.stats.as_dict(),
+                                "items_per_second": parses.stats.created / parses.stats.parse_time
+                                if parses.stats.parse_time else None,
+                                "latency": {"min": min(latencies), "p50": percentile(latencies, 50),
+                                            "p90": percentile(latencies, 90), "p99": percentile(latencies, 99),
+                                            "max": max(latencies)},
+                                "peak": peak})
+    settings = {"repeats": repeats, "max_items": max_items, "seed": seed, "python": platform.python_version(),
+                "machine": platform.machine(), "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    return {"settings": settings, "results": results}
+
+
+def compare_suites(old, new):
+    """
+    compares the median latencies of two runs of the benchmark suite
+    :param old: dictionary as returned by suite_benchmark
+    :param new: dictionary as returned by suite_benchmark
+    :return: list of tuples of level, lexicon, utterance, the old and the new median latency and their ratio for each
+            case that is in both runs
+    """
+    # the latencies of truncated parses are only comparable if they were stopped after the same number of ParseItems
+    if old["settings"].get("max_items") != new["settings"].get("max_items"):
+        raise ValueError("the runs were made with different max_items: " + str(old["settings"].get("max_items")) +
+                         " and " + str(new["settings"].get("max_items")))
+    old_latencies = {(r["level"], r["lexicon"], r["utterance"]): r["latency"]["p50"] for r in old["results"]}
+    comparison = []
+    for result in new["results"]:
+        case = (result["level"], result["lexicon"], result["utterance"])
+        if case in old_latencies:
+            comparison.append(case + (old_latencies[case], result["latency"]["p50"],
+                                      result["latency"]["p50"] / old_latencies[case]))
+    return comparison
+
+
+if __name__ == "__main__":
+    """
+    runs the memory benchmark for the utterances given as arguments or for the default utterances
+    with --evaluation as first argument, runs the scaling benchmark of the parallel evaluation instead
+    with --memo as first argument, runs the benchmark of the SubParseMemo instead
+    with --equivalence as first argument, compares the parses with and without prune_equivalent instead
+    with --suite [path] as arguments, runs the benchmark suite and saves the results as JSON (default:
+    benchmark_results.json)
+    with --compare old_path new_path as arguments, compares the median latencies of two saved runs of the suite
+    """
+    if sys.argv[1:2] == ["--suite"]:
+        path = sys.argv[2] if len(sys.argv) > 2 else "benchmark_results.json"
+        suite = suite_benchmark()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(suite, f, indent=1)
+        print("level\tlexicon\ttokens\tparses\tcreated\titems/s\tp50\tp90\tpeak_MB\ttruncated\tutterance")
+        for result in suite["results"]:
+            print(str(result["level"]) + "\t" + result["lexicon"] + "\t" + str(result["tokens"]) + "\t" +
+                  str(result["parses"]) + "\t" + str(result["stats"]["created"]) + "\t" +
+                  str(round(result["items_per_second"] or 0)) + "\t" +
+                  str(round(result["latency"]["p50"], 3)) + "\t" + str(round(result["latency"]["p90"], 3)) + "\t" +
+                  str(round(result["peak"] / 1e6, 2)) + "\t" + str(result["truncated"]) + "\t" + result["utterance"])
+        sys.exit()
+    if sys.argv[1:2] == ["--compare"]:
+        with open(sys.argv[2], encoding="utf-8") as f:
+            old = json.load(f)
+        with open(sys.argv[3], encoding="utf-8") as f:
+            new = json.load(f)
+        print("level\tlexicon\told_p50\tnew_p50\tratio\tutterance")
+        for level, lexicon_name, utterance, old_p50, new_p50, ratio in compare_suites(old, new):
+            print(str(level) + "\t" + lexicon_name + "\t" + str(round(old_p50, 3)) + "\t" + str(round(new_p50, 3)) +
+                  "\t" + str(round(ratio, 2)) + "\t" + utterance)
+        sys.exit()
+    use_world_picture()
+    if sys.argv[1:2] == ["--evaluation"]:
+        print("utterance\tworkers\tparses\tseconds\tspeedup\tequal")
+        for result in evaluation_benchmark(sys.argv[2:] or scaling_utterances, scaling_workers):
+            print(result["utterance"] + "\t" + str(result["workers"]) + "\t" + str(result["parses"]) + "\t" +
+                  str(round(result["time"], 2)) + "\t" + str(round(result["speedup"], 2)) + "\t" +
+                  str(result["equal"]))
+        sys.exit()
+    if sys.argv[1:2] == ["--equivalence"]:
+        print("utterance\tparses\trepresentatives\tseconds\tpruned_seconds\tequal")
+        for result in equivalence_benchmark(sys.argv[2:] or equivalence_utterances):
+            print(result["utterance"] + "\t" + str(result["parses"]) + "\t" + str(result["pruned_parses"]) + "\t" +
+                  str(round(result["time"], 2)) + "\t" + str(round(result["pruned_time"], 2)) + "\t" +
+                  str(result["equal"]))
+        sys.exit()
+    if sys.argv[1:2] == ["--memo"]:
+        print("utterance\tparses\tmemo_seconds\tfresh_seconds\tequal")
+        for result in memo_benchmark(sys.argv[2:] or memo_utterances):
+            print(result["utterance"] + "\t" + str(result["parses"]) + "\t" + str(round(result["memo_time"], 2)) +
+                  "\t" + str(round(result["fresh_time"], 2)) + "\t" + str(result["equal"]))
+        sys.exit()
+    utterances = sys.argv[1:] or benchmark_utterances
+    print("utterance\tparses\tpeak_MB\tretained_MB")
+    for result in memory_benchmark(utterances):
+        print(result["utterance"] + "\t" + str(result["parses"]) + "\t" + str(round(result["peak"] / 1e6, 2)) + "\t" +
+              str(round(result["retained"] / 1e6, 2)))
@@ -4,18 +4,19 @@ They are used to find the blocks in the Picture object described in the input ut
 """
 
 
-def position_test(blocks, block_locations, number, position):
+def position_test(blocks, block_locations, number, position, context):
     """
     finds all pairs of blocks b1 and b2 from blocks and block_locations respectively
     that stand in relation position to eachother and checks if number of blocks is true
     e.g. blocks is a list of all blue rectangles and block_locations a list of all red circles, number is 2, position is 'u'
     then the function returns the list of all blocks that are blue rectangles and are below 2 red circles and updates the
-    back_track attribute of each of those blue rectangles by adding the red circles that make the description true w.r.t
-    the specific blue rectangle
+    back_track of each of those blue rectangles in the context by adding the red circles that make the description true
+    w.r.t the specific blue rectangle
     :param blocks: list of blocks are the referenced block
     :param block_locations: list of blocks are the referenced blocks
     :param number: the number of blocks from block_locations that should fulfill the relation
     :param position: string for the relative position
+    :param context: the EvaluationContext (see floating_grammar.py) that keeps the back_tracks of the blocks
     :return: list of all blocks from blocks that stand in relation position to any block in block_locations
     """
     ref_blocks1 = blocks
@@ -49,7 +50,7 @@ def position_test(blocks, block_locations, number, position):
 
             if match == True:
                 matching_b2.add(b2)
-                b1.keep_track(b2)
+                context.keep_track(b1, b2)
 
         if matching_b2 != []:
             matching_combs.append((b1,matching_b2))
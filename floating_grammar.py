@@ -1,6 +1,11 @@
 import sys
-from collections import defaultdict
-from itertools import product
+import time
+import builtins
+import heapq
+import json
+import multiprocessing
+from collections import defaultdict, deque, OrderedDict
+from itertools import product, count
 from eval_helper import *
 from world import *
 
@@ -17,48 +22,201 @@ all green triangles that are over red squares that are over any circle
 whereas guessed blocks consists of all green triangles, red squares and circles that make this sentence true
 """
 
-# variable to store all blocks of the current picture
-allblocks = []
-# variable to store the guessed blocks for an input utterance
-guessed_blocks = set()
-# only needed when running this script separately for demo or testing purpose
-all_blocks_grid = []
+class EvaluationContext:
+    """
+    The state of evaluating logical forms w.r.t. a picture
+    Every session that parses utterances about its own picture uses its own context, so several parses can be evaluated
+    at the same time in one process, e.g. in different threads, without affecting each other. The context is passed to
+    Grammar.gen (and the other methods that evaluate formulas), to update_guess and to position_test; in the logical
+    forms of the lexicon, allblocks refers to the blocks of the context.
+    blocks: list of the Block objects of the picture
+    grid: the grid of the picture
+    guessed_blocks: set of the guessed blocks of the formula that is evaluated, see update_guess
+    back_tracks: dictionary mapping blocks to the list of blocks they stand in a relation to, see position_test
+    guess_updates: number of calls of update_guess so far, used to detect whether evaluating a formula updated the
+                   guessed blocks
+    denotations: denotations of the formulas evaluated w.r.t. the picture, see Grammar.memoize, the keys are pairs of a
+                 FormulaTable and a node id
+    """
+    def __init__(self, picture=None):
+        """
+        :param picture: None or a Picture object as defined in BlockPictureGenerator.py
+        """
+        self.blocks = []
+        self.grid = []
+        self.guessed_blocks = set()
+        self.back_tracks = {}
+        self.guess_updates = 0
+        self.denotations = {}
+        if picture is not None:
+            self.set_picture(picture)
+
+    def set_picture(self, picture):
+        """
+        updates the blocks by resetting and then adding all blocks of the Picture object
+        :param picture: a Picture object as defined in BlockPictureGenerator.py
+        :return: None
+        """
+        self.set_grid(picture.grid)
 
-def create_all_blocks(picture):
+    def set_grid(self, grid):
+        """
+        updates the blocks by resetting and then adding all blocks of a grid
+        :param grid: list of rows of Block objects or None
+        :return: None
+        """
+        self.blocks.clear()
+        # the denotations of the formulas w.r.t. the previous picture are not valid anymore
+        self.denotations.clear()
+        self.back_tracks.clear()
+        self.grid[:] = grid
+        for row in grid:
+            for b in row:
+                if b:
+                    self.blocks.append(b)
+
+    def keep_track(self, block, other):
+        """
+        adds a block to the back_track of another block
+        :param block: Block object
+        :param other: Block object that stands in a relation to block
+        :return: None
+        """
+        track = self.back_tracks.get(block)
+        if track is None:
+            track = self.back_tracks[block] = []
+        track.append(other)
+
+
+# the context used if no other context is given, e.g. by the GUI
+default_context = EvaluationContext()
+# variable to store all blocks of the current picture of default_context
+allblocks = default_context.blocks
+# variable to store the guessed blocks for an input utterance of default_context
+guessed_blocks = default_context.guessed_blocks
+# only needed when running this script separately for demo or testing purpose
+all_blocks_grid = default_context.grid
+# number of bits used for each word type in the coverage value of a ParseItem (see word_coverage)
+COVERAGE_FIELD_BITS = 8
+# guessed blocks of ParseItems that have not been evaluated
+no_guesses = frozenset()
+# denotations of the formulas evaluated with respect to the current picture of default_context, see Grammar.memoize
+denotations = default_context.denotations
+# in the processes of Grammar.evaluate_all: the grammar, the context and the FormulaTables the formulas are evaluated
+# with
+evaluation_grammar = None
+evaluation_context = None
+evaluation_tables = []
+# min. number of different formulas for each process of Grammar.evaluate_all, with fewer formulas they are evaluated by
+# fewer processes or by this process: starting a pool takes about 10 ms and evaluating a formula 30 to 270 microseconds
+# (crude lexicon, utterances of 3 to 5 tokens), so the processes are only worth it for several hundred formulas each
+min_formulas_per_process = 1000
+
+def create_all_blocks(picture, context=None):
     """
     updates the allblocks by resetting and then adding all blocks of the Picture object
     :param picture: a Picture object as defined in BlockPictureGenerator.py
+    :param context: None for default_context or the EvaluationContext whose picture is updated
     :return: None
     """
-    allblocks.clear()
-    grid = picture.grid
-    for row in grid:
-        for b in row:
-            if b:
-                allblocks.append(b)
+    if context is None:
+        context = default_context
+    context.set_picture(picture)
     return None
 
-def update_guess(blocks):
+def update_guess(blocks, context):
     """
-    updates the guessed_blocks variable by adding the referenced blocks and additionally
+    updates the guessed_blocks of the context by adding the referenced blocks and additionally
     recursively backtracking all matching blocks in order to get the complete list of guessed blocks
     :param blocks: list of Block objects, i.e. the referenced blocks
+    :param context: the EvaluationContext the formula is evaluated in
     :return: True
     """
+    context.guess_updates += 1
     guesses = set()
     stack = blocks.copy()
 
     while stack != []:
         b = stack.pop()
         guesses.add(b)
-        stack.extend(b.back_track)
-        b.back_track = []
-    for b in allblocks:
-        b.back_track = []
-    guessed_blocks.update(set(guesses))
+        stack.extend(context.back_tracks.pop(b, []))
+    context.back_tracks.clear()
+    context.guessed_blocks.update(guesses)
     return True
 
 
+def coverage_fields(words, memo=None):
+    """
+    assigns each word type of an utterance the index of its field in the coverage values of the parse, in the order of
+    their first occurrence, so the coverage values only have as many fields as the utterance has word types
+    :param words: list of the tokens of the input utterance
+    :param memo: None or the SubParseMemo of the parse, whose charts share the fields of its utterances
+    :return: dictionary mapping each word type of the utterance to the index of its field
+    """
+    if memo is not None:
+        return memo.fields_for(words)
+    fields = {}
+    for word in words:
+        fields.setdefault(word, len(fields))
+    return fields
+
+
+def word_coverage(word, fields):
+    """
+    returns the coverage value of a single occurrence of a token
+    coverage values are multisets of tokens packed into an int: each word type gets its own field of
+    COVERAGE_FIELD_BITS bits holding the number of its occurrences (see coverage_fields), so that the coverage of the
+    union of two parse items is simply the sum of their coverage values
+    :param word: string, a token of an input utterance
+    :param fields: dictionary mapping the word types of the utterance to their fields, see coverage_fields
+    :return: int
+    """
+    return 1 << (fields[word] * COVERAGE_FIELD_BITS)
+
+
+def coverage_limits(words, fields):
+    """
+    computes the two masks needed to check in constant time that two parse items do not cover more occurrences of a
+    token than there are in the input utterance:
+    the coverage values a and b can be combined iff (a + b + bias) & guard == 0
+    bias fills each field such that the highest bit of the field (the guard bit) is only set when the count of that
+    token exceeds its number of occurrences; for utterances without repeated tokens this is the same as a & b == 0
+    :param words: list of the tokens of the input utterance
+    :param fields: see word_coverage
+    :return: tuple of two ints (bias, guard)
+    """
+    max_count = (1 << (COVERAGE_FIELD_BITS - 1)) - 1
+    counts = defaultdict(int)
+    for word in words:
+        counts[word] += 1
+    bias = 0
+    guard = 0
+    for word, count in counts.items():
+        if count > max_count:
+            raise ValueError("token '" + word + "' occurs more than " + str(max_count) + " times")
+        offset = fields[word] * COVERAGE_FIELD_BITS
+        bias += (max_count - count) << offset
+        guard += (max_count + 1) << offset
+    return bias, guard
+
+
+def coverage_mask(words, fields):
+    """
+    computes the coverage value of a list of tokens and the mask of their coverage fields, so that it can be checked in
+    constant time whether a parse item covers all of them: the parse item with coverage value c covers all of the tokens
+    iff c & mask == coverage
+    :param words: list of tokens of the input utterance
+    :param fields: see word_coverage
+    :return: tuple of two ints (coverage, mask)
+    """
+    coverage = 0
+    mask = 0
+    for word in words:
+        coverage += word_coverage(word, fields)
+        mask |= ((1 << COVERAGE_FIELD_BITS) - 1) << (fields[word] * COVERAGE_FIELD_BITS)
+    return coverage, mask
+
+
 def create_lex_rules():
     """
     creates the crude lexical rules for learning from scratch
@@ -74,42 +232,722 @@ def create_lex_rules():
 
 
 
+class FormulaTable:
+    """
+    Hash-consed storage of the logical formulas built during one parse
+    Every formula is a node identified by an int: a functor (the logical form of a lexical rule) applied to a tuple of
+    argument nodes, e.g. "over(range(1,17))(red(...))" is the functor "over" with the nodes of "range(1,17)" and
+    "red(...)" as arguments. Identical formulas are stored only once, so two formulas are equal iff their ids are equal
+    and formulas share all common subformulas.
+    functors: list of the functor strings, indexed by node id
+    arguments: list of the tuples of argument node ids, indexed by node id
+    ids: dictionary mapping (functor, arguments) to the node id
+    strings: dictionary with the string representations of the nodes that have been rendered so far
+    compiled: dictionary with the closures evaluating the nodes that have been compiled so far (see Grammar.compile)
+    """
+    def __init__(self):
+        self.functors = []
+        self.arguments = []
+        self.ids = {}
+        self.strings = {}
+        self.compiled = {}
+
+    def __getstate__(self):
+        # the compiled closures cannot be pickled, they are compiled again when needed
+        state = self.__dict__.copy()
+        state["compiled"] = {}
+        return state
+
+    def node(self, functor, arguments):
+        """
+        :param functor: string, logical form of a lexical rule
+        :param arguments: tuple of node ids
+        :return: int, the id of the node of the functor applied to the arguments
+        """
+        key = (functor, arguments)
+        node = self.ids.get(key)
+        if node is None:
+            node = len(self.functors)
+            self.functors.append(functor)
+            self.arguments.append(arguments)
+            self.ids[key] = node
+        return node
+
+    def atom(self, functor):
+        """
+        :param functor: string, logical form of a lexical rule
+        :return: int, the id of the node of the logical form without any arguments
+        """
+        return self.node(functor, ())
+
+    def apply(self, function, argument):
+        """
+        :param function: int, node id of the formula that is applied
+        :param argument: int, node id of the formula it is applied to
+        :return: int, the id of the node of function(argument)
+        """
+        return self.node(self.functors[function], self.arguments[function] + (argument,))
+
+    def render(self, node):
+        """
+        creates the string representation of a formula, e.g. for printing it or for the learning algorithm
+        :param node: int, node id
+        :return: string
+        """
+        string = self.strings.get(node)
+        if string is None:
+            string = self.functors[node] + "".join(["(" + self.render(a) + ")" for a in self.arguments[node]])
+            self.strings[node] = string
+        return string
+
+    def after(self, node, other):
+        """
+        compares two formulas in the order of their string representations, which unlike the node ids does not depend
+        on the formulas stored before, e.g. by the earlier parses sharing the FormulaTable of a SubParseMemo
+        :param node: int, node id
+        :param other: int, node id
+        :return: True if the formula of node comes after the formula of other
+        """
+        return node != other and self.render(node) > self.render(other)
+
+
+
+
 class ParseItem:
     """
     Objects representing the logical formulas that the floating parser builds up step by step
+    ParseItems are immutable and share their subformulas with the ParseItems they are built from
     c: string, category of the formula
     s: int, size of the formula (= out of how many subformulas it is built)
     semantic: Truth value of the formula when evaluated with respect to a picture; None if the formula is not a complete
                 formula, i.e. if c is not "V"
-    components: list of pairs of words from the utterance and the lexical rule paired with it by the parser
-    str_form: string representation of the formula
-    guessed_blocks: list of Block Objects, list of the guessed blocks when formular is evaluate w.r.t a given picture
-                    the list is empty if formula is not complete yet, i.e. if c is not "V"
+    left, right: the two ParseItems the formula was combined from, None for lexical ParseItems
+    leaf: pair of the word from the utterance and the lexical rule paired with it by the parser, None if the ParseItem
+          was combined from two others
+    components: tuple of pairs of words from the utterance and the lexical rule paired with it by the parser, collected
+                on first access and then kept in _components
+    forms: the FormulaTable in which the formula is stored
+    form: int, node id of the formula in forms
+    formular: string representation of the formula
+    guessed_blocks: set of Block Objects, the guessed blocks when formular is evaluate w.r.t a given picture
+                    the set is empty if formula is not complete yet, i.e. if c is not "V"
     summed_weights: float, sum of the weights of the subformulas
-    included_words: list of the tokens of the input utterance that are not yet covered by the parse item
-    remaining_words: list the tokens of the input utterance that are already covered by the parse item
+    coverage: int, the multiset of the tokens of the input utterance that are already covered by the parse item
+              packed into an int as described in word_coverage
+    key: tuple of the node id of the formula and the multiset of the components packed into an int, two ParseItems
+         built during the same parse with the same key represent the same formula built from the same components
+    alternatives: list of the ParseItems with the same denotation that were collapsed into this one or into the
+                  ParseItems it is built from, only filled for the results of Grammar.gen with prune_equivalent=True
     """
-    def __init__(self, categorie, length, semantic, components, str_form, guesses, weight, rem, incl):
+    __slots__ = ("c", "s", "semantic", "left", "right", "leaf", "forms", "form", "guessed_blocks", "summed_weights",
+                 "coverage", "key", "alternatives", "_components")
+
+    def __init__(self, categorie, length, semantic, left, right, forms, form, guesses, weight, coverage, key,
+                 leaf=None):
         """
         :param categorie: string, category of the formula
         :param length: int, size of the formula
         :param semantic: Truth value of the formula or None
-        :param components: list of pairs of words from the utterance and the lexical rule paired with it by the parser
-        :param str_form: string representation of the formula
-        :param guesses: list of Block Objects or empty list
+        :param left: ParseItem the formula is combined from or None
+        :param right: ParseItem the formula is combined from or None
+        :param forms: FormulaTable the formula is stored in
+        :param form: int, node id of the formula
+        :param guesses: set of Block Objects or empty set
         :param weight: float, weight of the formula
-        :param rem: list of the tokens of the input utterance that are not yet covered by the parse item
-        :param incl: list the tokens of the input utterance that are already covered by the parse item
+        :param coverage: int, the tokens of the input utterance that are already covered by the parse item
+        :param key: tuple of the node id of the formula and the multiset of the components
+        :param leaf: pair of word and lexical rule for lexical ParseItems, None otherwise
+        """
+        set_attr = object.__setattr__
+        set_attr(self, "c", categorie)
+        set_attr(self, "s", length)
+        set_attr(self, "semantic", semantic)
+        set_attr(self, "left", left)
+        set_attr(self, "right", right)
+        set_attr(self, "leaf", leaf)
+        set_attr(self, "forms", forms)
+        set_attr(self, "form", form)
+        set_attr(self, "guessed_blocks", guesses)
+        set_attr(self, "summed_weights", weight)
+        set_attr(self, "coverage", coverage)
+        set_attr(self, "key", key)
+        set_attr(self, "alternatives", ())
+        set_attr(self, "_components", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ParseItem objects are immutable")
+
+    @property
+    def formular(self):
+        """
+        :return: string representation of the formula
+        """
+        return self.forms.render(self.form)
+
+    @property
+    def components(self):
+        """
+        collects the leaves of the formula from left to right, only on the first access as ParseItems are immutable
+        :return: tuple of pairs of words from the utterance and the lexical rule paired with it by the parser
+        """
+        if self._components is None:
+            components = []
+            stack = [self]
+            while stack:
+                item = stack.pop()
+                if item.leaf is not None:
+                    components.append(item.leaf)
+                elif item._components is not None:
+                    components.extend(item._components)
+                else:
+                    stack.append(item.right)
+                    stack.append(item.left)
+            object.__setattr__(self, "_components", tuple(components))
+        return self._components
+
+    def evaluated(self, semantic, guesses, alternatives=None):
+        """
+        creates a copy of the ParseItem with the result of evaluating its formula
+        :param semantic: Truth value of the formula
+        :param guesses: set of Block Objects
+        :param alternatives: list of equivalent ParseItems or None to keep the alternatives of the ParseItem
+        :return: a new ParseItem object
+        """
+        item = object.__new__(ParseItem)
+        for name in ParseItem.__slots__:
+            object.__setattr__(item, name, getattr(self, name))
+        object.__setattr__(item, "semantic", semantic)
+        object.__setattr__(item, "guessed_blocks", guesses)
+        if alternatives is not None:
+            object.__setattr__(item, "alternatives", alternatives)
+        return item
+
+
+class ParseStats:
+    """
+    counters of one parse, collected by Grammar.derive and by the evaluation and grouping of its parses
+    pops: number of ParseItems taken from the agenda
+    candidates: number of pairs of ParseItems whose combination was checked
+    created: number of combined ParseItems built from them, the other pairs were skipped because of the memo or failed
+             the checks before a ParseItem is built (coverage, size, completability, insertions, commutativity), see
+             precondition_pruned
+    memo_skipped: number of pairs that were not combined because the earlier parse seeding the chart already made the
+                  combination, see Grammar.derive with a SubParseMemo
+    duplicates: number of built ParseItems that were dropped as they were already in the chart or collapsed into
+                another ParseItem
+    cells: dictionary mapping (category, size) to the number of ParseItems in this cell of the chart after the parse
+    complete: number of complete ParseItems, i.e. of category "V" covering the tokens that must be covered
+    parse_time, evaluation_time, grouping_time: seconds spent building the chart, evaluating the complete ParseItems and
+                                                grouping them by their guessed blocks
+    cached: True if the parse was taken from a ForestCache, then only the evaluation and grouping are counted
+    """
+    def __init__(self):
+        self.pops = 0
+        self.candidates = 0
+        self.created = 0
+        self.memo_skipped = 0
+        self.duplicates = 0
+        self.cells = {}
+        self.complete = 0
+        self.parse_time = 0.0
+        self.evaluation_time = 0.0
+        self.grouping_time = 0.0
+        self.cached = False
+
+    @property
+    def precondition_pruned(self):
+        """
+        :return: number of pairs of ParseItems that were not combined because the combination failed a check
+        """
+        return self.candidates - self.created - self.memo_skipped
+
+    def as_dict(self):
+        """
+        :return: dictionary with all counters that can be written as JSON, the cells are keyed by "category,size"
+        """
+        return {"pops": self.pops, "candidates": self.candidates, "created": self.created,
+                "memo_skipped": self.memo_skipped, "duplicates": self.duplicates,
+                "precondition_pruned": self.precondition_pruned,
+                "cells": {c + "," + str(size): n for (c, size), n in sorted(self.cells.items())},
+                "complete": self.complete, "parse_time": self.parse_time, "evaluation_time": self.evaluation_time,
+                "grouping_time": self.grouping_time, "cached": self.cached}
+
+    def dump(self, path, **info):
+        """
+        appends the counters as one JSON line to a file, e.g. parse_stats.jsonl in the session folder
+        :param path: path of the file
+        :param info: further fields of the line, e.g. the utterance
+        :return: None
+        """
+        line = dict(info)
+        line.update(self.as_dict())
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line) + "\n")
+
+
+class ParseResult(list):
+    """
+    list of the ParseItems returned by Grammar.gen or yielded by Grammar.stream
+    truncated: True if the parser stopped because it reached the deadline or the max. number of ParseItems, then the
+               list only contains the complete ParseItems found so far
+    pruned: dictionary mapping the rules (pairs of child categories as in rules) to the number of ParseItems built by
+            them that were pruned because they denote no blocks, see Grammar.gen with prune_empty=True
+    stats: ParseStats of the parse
+    forest: None or the ParseForest of the parse, set by Grammar.stream with packed=True when the parse is finished
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.truncated = False
+        self.pruned = defaultdict(int)
+        self.stats = ParseStats()
+        self.forest = None
+
+
+class ParseForest:
+    """
+    packed shared parse forest returned by Grammar.forest
+    Every node is a ParseItem in the chart, i.e. one formula of one category built from the same tokens, and its
+    hyperedges are the pairs of ParseItems it can be combined from. All ParseItems of a node have the same formula, so
+    a node of category "V" only needs to be evaluated once for all of its trees and the best weights and the groups of
+    the trees by their guessed blocks are computed by dynamic programming over the nodes. Trees are only built as
+    ParseItems for the groups that are asked for.
+    truncated: see ParseResult
+    pruned: see ParseResult
+    stats: see ParseResult, the evaluation and grouping of the trees are added to it
+    """
+    def __init__(self, grammar, chart, alternatives, must_coverage, must_mask, result, lexicon=None, context=None):
+        """
+        :param grammar: the Grammar that built the forest
+        :param chart: the chart filled by Grammar.derive with packed=True
+        :param alternatives: dictionary mapping the category and key of a node to the other ParseItems with this
+                category and key, i.e. its other derivations
+        :param must_coverage: see Grammar.must_cover_mask
+        :param must_mask: see Grammar.must_cover_mask
+        :param result: the ParseResult passed to Grammar.derive
+        :param lexicon: None or the lexicon with the current weights of the lexical rules if they might have changed
+                since the chart was built, see ForestCache
+        :param context: None for default_context or the EvaluationContext the trees are evaluated in
+        """
+        self.grammar = grammar
+        self.context = context
+        self.chart = chart
+        self.alternatives = alternatives
+        self.truncated = result.truncated
+        self.pruned = result.pruned
+        self.stats = result.stats
+        # the complete nodes, i.e. the roots of all trees
+        self.roots = [item for (c, s), cell in chart.items() if c == 'V' for item in cell.values()
+                      if item.coverage & must_mask == must_coverage]
+        # caches of the dynamic programming, keyed by the category and the key of the nodes
+        self.best_weights = {}
+        self.tree_counts = {}
+        self.evaluated_roots = {}
+        self.trees_cache = {}
+        self.grouped_roots = None
+        # maps the word, category and logical form of the lexical rules to their current weights
+        self.lexical_weights = None
+        if lexicon is not None:
+            self.lexical_weights = {}
+            for word, lexical_rules in lexicon.items():
+                for categorie, function, weight in lexical_rules:
+                    # the parser only uses the first of several equal rules
+                    self.lexical_weights.setdefault((word, categorie, function), weight)
+
+    def leaf(self, node):
+        """
+        :param node: lexical ParseItem or ParseItem built out of the air
+        :return: the ParseItem or a copy of it with the current weight of its lexical rule
+        """
+        if self.lexical_weights is None or not node.leaf[0]:
+            return node
+        weight = self.lexical_weights.get((node.leaf[0], node.c, node.leaf[1]), node.summed_weights)
+        if weight == node.summed_weights:
+            return node
+        return ParseItem(node.c, 1, node.semantic, None, None, node.forms, node.form, no_guesses, weight, node.coverage,
+                         node.key, node.leaf)
+
+    def derivations(self, node):
+        """
+        :param node: ParseItem of a node that is not lexical
+        :return: list of the ParseItems of the node, one for each of its hyperedges
+        """
+        # the ParseItems refer to their children as they were when they were built, ForestCache.remove_rules might
+        # have replaced them in the chart since
+        return [self.chart[node.c, node.s][node.key]] + list(self.alternatives.get((node.c, node.key), ()))
+
+    def edges(self, node):
+        """
+        :param node: ParseItem of a node that is not lexical
+        :return: list of the pairs of ParseItems the node can be combined from
+        """
+        return [(derivation.left, derivation.right) for derivation in self.derivations(node)]
+
+    def best_weight(self, node):
+        """
+        :param node: ParseItem in the chart
+        :return: the highest weight of a tree of the node
+        """
+        node_id = (node.c, node.key)
+        if node_id not in self.best_weights:
+            if node.left is None:
+                self.best_weights[node_id] = self.leaf(node).summed_weights
+            else:
+                self.best_weights[node_id] = max(self.best_weight(left) + self.best_weight(right)
+                                                 for left, right in self.edges(node))
+        return self.best_weights[node_id]
+
+    def count(self, node=None):
+        """
+        :param node: ParseItem in the chart or None for all complete nodes
+        :return: the number of derivations of the node or of all complete nodes, this is an upper bound of the number
+                of its trees as trees with the same components are only built once, see trees
+        """
+        if node is None:
+            return sum(self.count(root) for root in self.roots)
+        node_id = (node.c, node.key)
+        if node_id not in self.tree_counts:
+            if node.left is None:
+                self.tree_counts[node_id] = 1
+            else:
+                self.tree_counts[node_id] = sum(self.count(left) * self.count(right) for left, right in self.edges(node))
+        return self.tree_counts[node_id]
+
+    def evaluate(self, root):
+        """
+        :param root: ParseItem of category "V" in the chart
+        :return: copy of the ParseItem with its truth value and guessed blocks, see Grammar.evaluate
+        """
+        node_id = (root.c, root.key)
+        if node_id not in self.evaluated_roots:
+            start = time.perf_counter()
+            self.evaluated_roots[node_id] = self.grammar.evaluate(root, context=self.context)
+            self.stats.evaluation_time += time.perf_counter() - start
+        return self.evaluated_roots[node_id]
+
+    def trees(self, node, limit=None):
+        """
+        builds the trees of a node in non-increasing order of their weights
+        :param node: ParseItem in the chart
+        :param limit: None for all trees or the max. number of trees
+        :return: list of ParseItems, trees of category "V" are evaluated
+        """
+        node_id = (node.c, node.key)
+        if (node_id, limit) in self.trees_cache:
+            return self.trees_cache[node_id, limit]
+        if node.left is None:
+            trees = [self.leaf(node)]
+        else:
+            # with a limit only the best trees of the children can be part of the best trees of the node
+            candidates = []
+            for derivation in self.derivations(node):
+                for left in self.trees(derivation.left, limit):
+                    for right in self.trees(derivation.right, limit):
+                        candidates.append((left.summed_weights + right.summed_weights, left, right, derivation))
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            trees = []
+            # trees that only differ in which tokens the lexical rules are paired with can have the same components,
+            # like gen only one of them is kept
+            components = set()
+            for weight, left, right, derivation in candidates:
+                if left is derivation.left and right is derivation.right:
+                    tree = derivation
+                else:
+                    tree = ParseItem(node.c, node.s, None, left, right, node.forms, node.form, no_guesses, weight,
+                                     node.coverage, node.key)
+                tree_components = tuple(sorted(tree.components))
+                if tree_components in components:
+                    continue
+                components.add(tree_components)
+                trees.append(tree)
+                if len(trees) == limit:
+                    break
+            if node.c == 'V':
+                evaluated = self.evaluate(node)
+                trees = [tree.evaluated(evaluated.semantic, evaluated.guessed_blocks) for tree in trees]
+        self.trees_cache[node_id, limit] = trees
+        return trees
+
+    def groups(self, k=None, limit=None):
+        """
+        groups the complete nodes that evaluate to True by their guessed blocks and builds the trees of the k groups
+        with the highest weights, without building any other tree
+        :param k: None for all groups or the max. number of groups
+        :param limit: None for all trees of a group or the max. number of trees of a group
+        :return: a dictionary and a list as returned by grouping, restricted to the k best groups
+        """
+        sorted_guesses = self.guesses()[:k]
+        return {guesses: self.group(guesses, limit) for guesses in sorted_guesses}, sorted_guesses
+
+    def guesses(self):
+        """
+        evaluates the complete nodes and groups those that evaluate to True by their guessed blocks
+        :return: list of all guessed blocks combinations ordered by the max weight of a corresponding tree in descending
+                order, as returned by grouping
+        """
+        start = time.perf_counter()
+        evaluation_time = self.stats.evaluation_time
+        if self.grouped_roots is None:
+            self.grouped_roots = defaultdict(list)
+            for root in self.roots:
+                evaluated = self.evaluate(root)
+                if evaluated.semantic:
+                    self.grouped_roots[evaluated.guessed_blocks].append(root)
+        max_weights = [(guesses, max(self.best_weight(root) for root in roots))
+                       for guesses, roots in self.grouped_roots.items()]
+        max_weights.sort(key=lambda pair: pair[1], reverse=True)
+        # the time of the evaluation is counted separately
+        self.stats.grouping_time += time.perf_counter() - start - (self.stats.evaluation_time - evaluation_time)
+        return [guesses for (guesses, weight) in max_weights]
+
+    def group(self, guesses, limit=None):
+        """
+        :param guesses: frozenset of Block objects
+        :param limit: None for all trees or the max. number of trees
+        :return: list of the trees that evaluate to True with these guessed blocks sorted by their weights in
+                descending order, trees with the same weight by their formulas
+        """
+        if self.grouped_roots is None:
+            self.guesses()
+        trees = [tree for root in self.grouped_roots.get(guesses, ()) for tree in self.trees(root, limit)]
+        trees.sort(key=lambda p_item: (-p_item.summed_weights, p_item.formular))
+        return trees[:limit]
+
+    def parses(self, limit=None):
+        """
+        :param limit: None for all trees of a complete node or the max. number of trees of a complete node
+        :return: ParseResult with the evaluated trees of all complete nodes, as returned by Grammar.gen
+        """
+        results = ParseResult(tree for root in self.roots for tree in self.trees(root, limit))
+        results.truncated = self.truncated
+        results.pruned = self.pruned
+        results.stats = self.stats
+        return results
+
+
+class ForestCache:
+    """
+    LRU cache of the packed parse forests built by Grammar.forest without their evaluation
+    What the parser derives only depends on the tokens of the utterance and their lexical rules, not on the picture, so
+    the chart of a repeated utterance is reused and only its complete nodes are evaluated again w.r.t. the current
+    picture. Every entry is stamped with the categories and logical forms of the lexical rules of its tokens and only
+    used as long as the lexicon still has the same rules for them, the weights of the rules are taken from the current
+    lexicon. remove_rules prunes the entries whose tokens lost rules instead of dropping them.
+    The cache is meant for one set of rules and out_of_air and only holds forests that were not truncated.
+    """
+    def __init__(self, size=32):
+        """
+        :param size: the max. number of forests kept
+        """
+        self.size = size
+        # maps the tokens and the options of a parse to the stamp of the lexicon and the arguments of ParseForest
+        # except the grammar, the least recently used entry first
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(words, must_cover=False, skippable=(), max_insertions=None, insertion_categories=None):
+        """
+        :param words: list of tokens
+        :param must_cover: see Grammar.gen
+        :param skippable: see Grammar.gen
+        :param max_insertions: see Grammar.gen
+        :param insertion_categories: see Grammar.gen
+        :return: the key of the parse in the cache
+        """
+        return (tuple(words), must_cover, frozenset(skippable), max_insertions,
+                None if insertion_categories is None else frozenset(insertion_categories))
+
+    @staticmethod
+    def stamp(lexicon, words):
+        """
+        :param lexicon: dictionary mapping words to lists of (category, logical form, weight) tuples
+        :param words: list of tokens
+        :return: version stamp of the lexical rules of the tokens without their weights
+        """
+        return tuple((word, tuple((categorie, function) for categorie, function, weight in lexicon.get(word, ())))
+                     for word in sorted(set(words)))
+
+    def get(self, key, stamp):
+        """
+        :param key: tuple of the tokens and the options of a parse, see Grammar.forest
+        :param stamp: see stamp
+        :return: the cached arguments of ParseForest or None if the parse is not cached with this stamp
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != stamp:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def contains(self, lexicon, s, must_cover=False, skippable=(), max_insertions=None, insertion_categories=None):
+        """
+        :param lexicon: the lexicon of the grammar
+        :param s: string, the input utterance
+        :param must_cover: see Grammar.gen
+        :param skippable: see Grammar.gen
+        :param max_insertions: see Grammar.gen
+        :param insertion_categories: see Grammar.gen
+        :return: True if Grammar.forest takes the forest of the utterance from the cache
+        """
+        words = s.split()
+        entry = self.entries.get(self.key(words, must_cover, skippable, max_insertions, insertion_categories))
+        return entry is not None and entry[0] == self.stamp(lexicon, words)
+
+    def put(self, key, stamp, forest_args):
+        """
+        adds a parse to the cache and removes the least recently used ones if the cache is full
+        :param key: see get
+        :param stamp: see stamp
+        :param forest_args: tuple of the chart, the alternatives, the must-cover coverage and mask and the ParseResult
+        :return: None
+        """
+        self.entries[key] = (stamp, forest_args)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def remove_rules(self, word, deleted, lexicon):
+        """
+        removes all ParseItems that contain one of the deleted lexical rules of a word from the cached forests of
+        utterances with this word, the lexicon has to be updated already
+        :param word: string, the token
+        :param deleted: collection of the logical forms of the deleted lexical rules of the word
+        :param lexicon: the updated lexicon
+        :return: None
+        """
+        for key, (stamp, forest_args) in list(self.entries.items()):
+            words = key[0]
+            if word not in words:
+                continue
+            # the entry can only be pruned if the deleted rules are the only change of the lexicon for its tokens and
+            # the word still has rules, otherwise it is dropped
+            expected = tuple((w, tuple(r for r in rules if w != word or r[1] not in deleted)) for w, rules in stamp)
+            if expected != self.stamp(lexicon, words) or not lexicon.get(word):
+                del self.entries[key]
+                continue
+            chart, alternatives, must_coverage, must_mask, result = forest_args
+            pruned_chart = defaultdict(dict)
+            pruned_alternatives = {}
+            # the category and key of the removed ParseItems, a combined ParseItem is removed if all of its
+            # derivations contain a removed ParseItem; the cells are visited from the smallest to the largest size so
+            # all children are visited before their parents
+            removed = set()
+            for (c, size) in sorted(chart, key=lambda cell: cell[1]):
+                for item_key, item in chart[c, size].items():
+                    if item.left is None:
+                        derivations = [] if item.leaf[0] == word and item.leaf[1] in deleted else [item]
+                    else:
+                        derivations = [derivation for derivation in
+                                       [item] + list(alternatives.get((c, item_key), ()))
+                                       if (derivation.left.c, derivation.left.key) not in removed and
+                                       (derivation.right.c, derivation.right.key) not in removed]
+                    if not derivations:
+                        removed.add((c, item_key))
+                        continue
+                    pruned_chart[c, size][item_key] = derivations[0]
+                    if len(derivations) > 1:
+                        pruned_alternatives[c, item_key] = derivations[1:]
+            self.entries[key] = (expected, (pruned_chart, pruned_alternatives, must_coverage, must_mask, result))
+
+
+class SubParseMemo:
+    """
+    memo of the charts of earlier parses for seeding the parse of the next utterances, see Grammar.derive
+    Utterances of a session share many tokens, and all ParseItems of an earlier parse that only cover tokens of the new
+    utterance do not need to be derived again, so the work of a parse mostly depends on the tokens that are new.
+    The charts are stored under the multiset of the tokens of their utterance and are stamped with the lexical rules of
+    the tokens including their weights (see stamp), only the tokens whose rules did not change since are shared with a
+    new utterance: the weights decide which derivation of a formula is combined further, so a chart built with other
+    weights would not yield the same parses as a new parse. All parses using the memo store their formulas in the same
+    FormulaTable and assign the same coverage fields to the same tokens, so the ParseItems of a chart can be seeded as
+    they are.
+    """
+    def __init__(self, size=16, max_fields=64):
         """
-        self.c = categorie
-        self.s = length
-        self.semantic = semantic
-        self.components = components
-        self.formular = str_form
-        self.guessed_blocks = guesses
-        self.summed_weights = weight
-        self.included_words = incl
-        self.remaining_words = rem
+        :param size: the max. number of charts kept
+        :param max_fields: the max. number of coverage fields, the memo is emptied when the tokens of a new utterance
+                would exceed it, which keeps the coverage values small
+        """
+        self.size = size
+        self.max_fields = max_fields
+        self.forms = FormulaTable()
+        # the coverage field of each token of the utterances parsed with the memo, see coverage_fields
+        self.fields = {}
+        # maps the sorted tokens of an utterance and the options of its parse to a tuple of the tokens,
+        # the stamp of their lexical rules and the chart, the alternatives, the size limits of the categories and the
+        # pruning functions completable and too_large of its parse, the least recently used entry first
+        self.entries = OrderedDict()
+
+    def fields_for(self, words):
+        """
+        assigns coverage fields to the tokens of an utterance that do not have one yet, after emptying the memo if they
+        do not fit
+        :param words: list of the tokens of the utterance
+        :return: the dictionary mapping the tokens to their fields, shared by all parses using the memo
+        """
+        new_words = set(words).difference(self.fields)
+        if len(self.fields) + len(new_words) > self.max_fields:
+            self.entries.clear()
+            self.fields = {}
+            self.forms = FormulaTable()
+        for word in words:
+            self.fields.setdefault(word, len(self.fields))
+        return self.fields
+
+    @staticmethod
+    def stamp(lexicon, words):
+        """
+        :param lexicon: dictionary mapping words to lists of (category, logical form, weight) tuples
+        :param words: list of tokens
+        :return: dictionary mapping each of the tokens to a version stamp of its lexical rules with their weights
+        """
+        return {word: tuple(lexicon.get(word, ())) for word in set(words)}
+
+    def block(self, lexicon, words, options):
+        """
+        finds the earlier parse with the same options that shares the most tokens with an utterance
+        :param lexicon: the lexicon of the grammar
+        :param words: list of the tokens of the utterance
+        :param options: the options of the parse as in the key of a ForestCache without the tokens
+        :return: None or a tuple of the shared tokens and the chart, the alternatives, the size limits and the pruning
+                functions of the earlier parse
+        """
+        stamp = self.stamp(lexicon, words)
+        best = None
+        best_shared = []
+        for key, (block_words, block_stamp, block_parse) in self.entries.items():
+            if key[1:] != options:
+                continue
+            remaining = list(block_words)
+            shared = []
+            for word in words:
+                if word in remaining and block_stamp[word] == stamp[word]:
+                    remaining.remove(word)
+                    shared.append(word)
+            if len(shared) > len(best_shared):
+                best, best_shared = key, shared
+        if best is None:
+            return None
+        self.entries.move_to_end(best)
+        return (best_shared,) + self.entries[best][2]
+
+    def put(self, words, lexicon, options, block_parse):
+        """
+        stores the chart of a parse and removes the least recently used ones if the memo is full
+        :param words: list of the tokens of the utterance
+        :param lexicon: the lexicon of the grammar
+        :param options: see block
+        :param block_parse: tuple of the chart, the alternatives, the size limits and the pruning functions completable
+                and too_large (None without must_cover) of the parse
+        :return: None
+        """
+        key = (tuple(sorted(words)),) + options
+        self.entries[key] = (tuple(words), self.stamp(lexicon, words), block_parse)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
 
 
 
@@ -128,207 +966,1110 @@ class Grammar:
         self.lexicon = lexicon
         self.functions = functions
         self.rules = rules
+        self.combinations = index_rules(rules)
+        # closures evaluating the logical forms of the lexical rules, see compile_functor
+        self.compiled_functors = {}
+        # results of analyse_rules for the sets of categories of lexical ParseItems that occurred so far
+        self.goal_analyses = {}
 
 
 
-    def gen(self,s):
+    def gen(self, s, prune_equivalent=False, beam_width=None, deadline=None, max_items=None, must_cover=False,
+            skippable=(), prune_empty=False, max_insertions=None, insertion_categories=None, memo=None,
+            eval_workers=None, context=None):
         """
         The Floating Parser
+        The parse is not distributed to several processes: each ParseItem is combined with the ParseItems built before,
+        and parsing parts of the lexicon in separate processes builds the ParseItems shared by the parts in each of them,
+        so such a parse does more work in total and was not faster than this one. Only the evaluation of the complete
+        ParseItems can be distributed, see eval_workers.
+        :param s: string, the input utterance
+        :param prune_equivalent: if True, the ParseItems of the categories in equivalence_categories are evaluated w.r.t.
+                the current picture while parsing and ParseItems with the same category, size, coverage and denotation
+                are collapsed into the one with the highest weight, all complete formulas represented by a complete
+                ParseItem are kept in its alternatives, see expand_equivalents
+        :param beam_width: None to explore all formulas up to the max. length, or an int to parse best-first: the agenda
+                is ordered by the weight of the ParseItems plus an optimistic estimate of the weight of the tokens they
+                do not cover yet and each chart cell keeps only the beam_width ParseItems with the highest score
+        :param deadline: None or the number of seconds after which the parser stops building new formulas
+        :param max_items: None or the number of combined ParseItems after which the parser stops building new formulas
+        :param must_cover: if True, only formulas that cover all tokens except the skippable ones are complete and
+                ParseItems that cannot be completed to such a formula not exceeding the max. length are not built
+        :param skippable: collection of the tokens that do not need to be covered with must_cover, tokens without any
+                lexical rule are always skippable
+        :param prune_empty: if True, the combined ParseItems of the categories in block_categories are evaluated w.r.t.
+                the current picture while parsing and dropped if they denote no blocks, unless the parse contains a
+                number that allows 0 blocks; this also drops disjunctions with a false disjunct, which evaluate to the
+                same guessed blocks as the other disjunct alone
+        :param max_insertions: None or the max. number of ParseItems built out of the air in one formula; if None, the
+                formulas are only limited to the max. length of the number of tokens + 4, otherwise to the number of
+                tokens + max_insertions
+        :param insertion_categories: None or a collection of the categories of the ParseItems that ParseItems built out
+                of the air may be combined with; if None, they are combined as allowed by the rules
+        :param memo: None or a SubParseMemo: the parse is seeded with the ParseItems of earlier parses covering tokens of
+                this utterance and added to the memo, see Grammar.derive; not used with prune_equivalent, beam_width or
+                prune_empty
+        :param eval_workers: None or the max. number of processes the complete ParseItems are evaluated by, only used for
+                large parses, see evaluate_all; not used with memo
+        :param context: None for default_context or the EvaluationContext the formulas are evaluated in
+        :return: a ParseResult with all ParseItems that correspond to all possible logical formulas of category "V" that
+                can be generated for the input utterance based on the grammar, or those found until the deadline or
+                max_items was reached, then its truncated flag is set; its stats count the parse and the evaluation
+        """
+        if memo is not None and not prune_equivalent and beam_width is None and not prune_empty:
+            # the memo needs packed ParseItems, whose trees are the same as the ParseItems built otherwise
+            return self.forest(s, deadline, max_items, must_cover, skippable, max_insertions=max_insertions,
+                               insertion_categories=insertion_categories, memo=memo, context=context).parses()
+        results = ParseResult()
+        chart = defaultdict(dict)
+        alternatives = {}
+        for complete_items, bound in self.derive(s, chart, alternatives, prune_equivalent, beam_width,
+                                                 deadline=deadline, max_items=max_items, result=results,
+                                                 must_cover=must_cover, skippable=skippable, prune_empty=prune_empty,
+                                                 max_insertions=max_insertions,
+                                                 insertion_categories=insertion_categories, context=context):
+            pass
+        words = s.split()
+        must_coverage, must_mask = self.must_cover_mask(words, must_cover, skippable)
+
+        # keep track that ParseItems that represent the same formula built from the same components only occur once in the result
+        included_keys = set()
+        complete_items = []
+        # out of all the formulas the parse built up, only return those that are complete, i.e. category = "V" and can
+        # be evaluated
+        for (c,s) in chart:
+            if c == 'V':
+                for item in chart[c,s].values():
+                    if item.key in included_keys or item.coverage & must_mask != must_coverage:
+                        continue
+                    complete_items.append(item)
+                    included_keys.add(item.key)
+
+        # the ParseItems collapsed by prune_equivalent or removed by the beam are not counted
+        results.stats.complete = len(complete_items)
+        start = time.perf_counter()
+        if prune_equivalent:
+            max_size = len(words) + (4 if max_insertions is None else max_insertions)
+            results.extend(self.evaluate_all(complete_items, eval_workers,
+                                             self.expand_equivalents(chart, complete_items, alternatives, max_size,
+                                                                     max_insertions), context=context))
+        else:
+            results.extend(self.evaluate_all(complete_items, eval_workers, context=context))
+        results.stats.evaluation_time += time.perf_counter() - start
+        return results
+
+
+    def stream(self, s, prune_equivalent=False, beam_width=None, deadline=None, max_items=None, result=None,
+               must_cover=False, skippable=(), prune_empty=False, max_insertions=None, insertion_categories=None,
+               context=None, packed=False, cache=None, memo=None):
+        """
+        anytime version of gen: parses best-first and yields the evaluated ParseItems of category "V" in non-increasing
+        order of their weights as soon as no ParseItem with a higher weight can be derived anymore, so the first
+        parses are available long before the parse is complete and the rest of the search is only done if needed
+        the ParseItems yielded have no alternatives
+        :param s: string, the input utterance
+        :param prune_equivalent: see gen
+        :param beam_width: see gen
+        :param deadline: see gen, only the time spent parsing counts, not the time the generator is paused in between
+                two ParseItems
+        :param max_items: see gen
+        :param result: None or a ParseResult to which the yielded ParseItems are appended, its truncated flag is set if
+                the parse is stopped by deadline or max_items
+        :param must_cover: see gen
+        :param skippable: see gen
+        :param prune_empty: see gen
+        :param max_insertions: see gen
+        :param insertion_categories: see gen
+        :param context: see gen
+        :param packed: if True, the parse is packed as by forest and result.forest is set to its ParseForest when the
+                parse is finished, so the parses that were not yielded can be taken from the forest without parsing
+                again; only the derivation with the highest weight of each formula is yielded; not used with
+                prune_equivalent, beam_width or prune_empty
+        :param cache: None or a ForestCache the ParseForest is added to, only with packed, see forest
+        :param memo: None or a SubParseMemo the parse is seeded from and added to, only with packed, see forest
+        :return: generator of ParseItems
+        """
+        if result is None:
+            result = ParseResult()
+        if context is None:
+            context = default_context
+        if prune_equivalent or beam_width is not None or prune_empty:
+            packed = False
+        words = s.split()
+        if packed and cache is not None:
+            key = cache.key(words, must_cover, skippable, max_insertions, insertion_categories)
+            stamp = cache.stamp(self.lexicon, words)
+        chart = defaultdict(dict)
+        alternatives = {}
+        # heap of (negated weight, insertion number, ParseItem) entries of the complete ParseItems not yielded yet
+        found = []
+        insertions = count().__next__
+        # keys of the ParseItems yielded, with packed further derivations of them are not yielded
+        yielded = set()
+        for complete_items, bound in self.derive(s, chart, alternatives, prune_equivalent, beam_width, True,
+                                                 deadline, max_items, result, must_cover, skippable, prune_empty,
+                                                 max_insertions, insertion_categories, packed,
+                                                 memo if packed else None, context):
+            for item in complete_items:
+                heapq.heappush(found, (-item.summed_weights, insertions(), item))
+            # bound is the highest score of any ParseItem on the agenda, i.e. the highest weight any new complete
+            # ParseItem can have, it is None when the parse is complete
+            while found and (bound is None or -found[0][0] >= bound):
+                item = heapq.heappop(found)[2]
+                # the ParseItem might have been removed from the chart by the beam or by prune_equivalent
+                if item.key in chart[item.c, item.s] and item.key not in yielded:
+                    yielded.add(item.key)
+                    start = time.perf_counter()
+                    item = self.evaluate(item, context=context)
+                    result.stats.evaluation_time += time.perf_counter() - start
+                    result.append(item)
+                    yield item
+        if packed:
+            must_coverage, must_mask = self.must_cover_mask(words, must_cover, skippable, coverage_fields(words, memo))
+            if cache is not None and not result.truncated:
+                # the ParseItems yielded are not kept in the cache
+                cached_result = ParseResult()
+                cached_result.pruned = result.pruned
+                cached_result.stats = result.stats
+                cache.put(key, stamp, (chart, alternatives, must_coverage, must_mask, cached_result))
+            result.forest = ParseForest(self, chart, alternatives, must_coverage, must_mask, result, context=context)
+
+
+    def stream_guesses(self, s, parses=None, prune_equivalent=False, beam_width=None, deadline=None, max_items=None,
+                       must_cover=False, skippable=(), prune_empty=False, max_insertions=None,
+                       insertion_categories=None, context=None, packed=False, cache=None, memo=None):
+        """
+        yields the guessed blocks of the parses of an utterance that evaluate to True in the order of grouping, i.e.
+        ordered by the highest weight of a parse with these guessed blocks, as soon as they are found by stream
+        :param s: string, the input utterance
+        :param parses: None or a ParseResult to which all ParseItems yielded by stream are appended
+        :param prune_equivalent: see gen
+        :param beam_width: see gen
+        :param deadline: see stream
+        :param max_items: see gen
+        :param must_cover: see gen
+        :param skippable: see gen
+        :param prune_empty: see gen
+        :param max_insertions: see gen
+        :param insertion_categories: see gen
+        :param context: see gen
+        :param packed: see stream, parses.forest is set to the ParseForest of the parse when it is finished
+        :param cache: see stream
+        :param memo: see stream
+        :return: generator of frozensets of Block objects
+        """
+        seen_guesses = set()
+        for item in self.stream(s, prune_equivalent, beam_width, deadline, max_items, parses, must_cover, skippable,
+                                prune_empty, max_insertions, insertion_categories, context, packed, cache, memo):
+            if item.semantic and item.guessed_blocks not in seen_guesses:
+                seen_guesses.add(item.guessed_blocks)
+                yield item.guessed_blocks
+
+
+    def forest(self, s, deadline=None, max_items=None, must_cover=False, skippable=(), prune_empty=False,
+               max_insertions=None, insertion_categories=None, cache=None, memo=None, context=None):
+        """
+        alternative to gen that returns the parses as a packed shared forest, in which all derivations of the same
+        formula of the same category from the same tokens are one node
         :param s: string, the input utterance
-        :return: a list of all ParseItems that correspond to all possible logical formulas of category "V" that can be
-                generated for the input utterance based on the grammar
+        :param deadline: see gen
+        :param max_items: see gen
+        :param must_cover: see gen
+        :param skippable: see gen
+        :param prune_empty: see gen
+        :param max_insertions: see gen
+        :param insertion_categories: see gen
+        :param cache: None or a ForestCache the forest is taken from if the utterance was parsed with the same options
+                and lexical rules before and added to otherwise; not used with prune_empty, which depends on the picture
+        :param memo: None or a SubParseMemo the parse is seeded from and added to, see Grammar.derive; not used with
+                prune_empty
+        :param context: see gen, the trees of the forest are evaluated in this context
+        :return: a ParseForest whose trees are the ParseItems gen would return
+        """
+        words = s.split()
+        if cache is not None and not prune_empty:
+            key = cache.key(words, must_cover, skippable, max_insertions, insertion_categories)
+            stamp = cache.stamp(self.lexicon, words)
+            forest_args = cache.get(key, stamp)
+            if forest_args is not None:
+                forest = ParseForest(self, *forest_args, lexicon=self.lexicon, context=context)
+                # the stats of the cached parse belong to the earlier evaluation
+                forest.stats = ParseStats()
+                forest.stats.cached = True
+                forest.stats.complete = len(forest.roots)
+                return forest
+        else:
+            cache = None
+        if prune_empty:
+            memo = None
+        result = ParseResult()
+        chart = defaultdict(dict)
+        alternatives = {}
+        for complete_items, bound in self.derive(s, chart, alternatives, deadline=deadline, max_items=max_items,
+                                                 result=result, must_cover=must_cover, skippable=skippable,
+                                                 prune_empty=prune_empty, max_insertions=max_insertions,
+                                                 insertion_categories=insertion_categories, packed=True, memo=memo,
+                                                 context=context):
+            pass
+        must_coverage, must_mask = self.must_cover_mask(words, must_cover, skippable, coverage_fields(words, memo))
+        if cache is not None and not result.truncated:
+            cache.put(key, stamp, (chart, alternatives, must_coverage, must_mask, result))
+        return ParseForest(self, chart, alternatives, must_coverage, must_mask, result, context=context)
+
+
+    def evaluate(self, item, alternatives=None, context=None):
+        """
+        evaluates a complete ParseItem w.r.t. the current picture
+        :param item: ParseItem of category "V"
+        :param alternatives: None or list of ParseItems that were collapsed into item, they are evaluated as well
+        :param context: None for default_context or the EvaluationContext the formula is evaluated in
+        :return: a copy of the ParseItem with its truth value and guessed blocks
+        """
+        if context is None:
+            context = default_context
+        guessed_blocks = context.guessed_blocks
+        # evaluate the formula
+        semantic = self.sem(item, context)
+        # store the guessed_blocks that were created during evaluation and reset for next formula
+        # if average of weights should be computed for the total weight of a formula, the weight of the
+        # evaluated item has to be item.summed_weights / item.s
+        guesses = frozenset(guessed_blocks)
+        guessed_blocks.clear()
+        if alternatives is not None:
+            # the collapsed ParseItems denote the same as their representative
+            alternatives = [alternative.evaluated(semantic, guesses) for alternative in alternatives]
+        return item.evaluated(semantic, guesses, alternatives)
+
+
+    def evaluate_all(self, items, workers=None, alternatives=None, chunk_size=None, context=None):
+        """
+        evaluates complete ParseItems w.r.t. the current picture, by this process or by a pool of processes
+        The picture and the FormulaTables of the ParseItems are sent to each process once when it is started (see
+        init_evaluation), then the formulas are sent to them in chunks of node ids and the processes send back the
+        value and the guessed blocks of each formula (see evaluate_part). Each formula is evaluated only once even if
+        several ParseItems share it, also by this process. The processes use the functions of this module, not
+        self.functions. Each process gets at least min_formulas_per_process formulas, so small parses are evaluated by
+        this process even if workers is given.
+        :param items: list of ParseItems of category "V"
+        :param workers: None or the max. number of processes, the ParseItems are evaluated by this process if it is None
+                or 1
+        :param alternatives: None or a list with the alternatives of each ParseItem, see evaluate
+        :param chunk_size: None or the number of formulas sent to a process at once, if None the formulas are split
+                into 4 chunks for each process
+        :param context: None for default_context or the EvaluationContext with the picture
+        :return: list of the evaluated copies of the ParseItems in the same order, the same as evaluate returns
+        """
+        if context is None:
+            context = default_context
+        if alternatives is None:
+            alternatives = [None] * len(items)
+        tables = []
+        table_ids = {}
+        # maps the formulas to the first ParseItem with the formula
+        formulas = {}
+        for item in items:
+            table_id = table_ids.get(id(item.forms))
+            if table_id is None:
+                table_id = table_ids[id(item.forms)] = len(tables)
+                tables.append(item.forms)
+            formulas.setdefault((table_id, item.form), item)
+        if workers is not None:
+            workers = min(workers, len(formulas) // min_formulas_per_process)
+        denoted = {}
+        if workers is None or workers <= 1:
+            for formula, item in formulas.items():
+                item = self.evaluate(item, context=context)
+                denoted[formula] = item.semantic, item.guessed_blocks
+        else:
+            formulas = list(formulas)
+            if chunk_size is None:
+                chunk_size = len(formulas) // (4 * workers) + 1
+            chunks = [formulas[i:i + chunk_size] for i in range(0, len(formulas), chunk_size)]
+            with multiprocessing.Pool(min(workers, len(chunks)), init_evaluation, (context.blocks, tables)) as pool:
+                parts = pool.map(evaluate_part, chunks)
+            # the processes refer to the blocks of the picture by their index in the blocks of the context
+            for chunk, part in zip(chunks, parts):
+                for formula, (semantic, guess_ids) in zip(chunk, part):
+                    denoted[formula] = semantic, frozenset(context.blocks[i] for i in guess_ids)
+        evaluated = []
+        for item, item_alternatives in zip(items, alternatives):
+            semantic, guesses = denoted[table_ids[id(item.forms)], item.form]
+            if item_alternatives is not None:
+                item_alternatives = [alternative.evaluated(semantic, guesses) for alternative in item_alternatives]
+            evaluated.append(item.evaluated(semantic, guesses, item_alternatives))
+        return evaluated
+
+
+    def must_cover_mask(self, words, must_cover, skippable, fields=None):
+        """
+        :param words: list of the tokens of the input utterance
+        :param must_cover: see gen
+        :param skippable: see gen
+        :param fields: the coverage fields of the parse, by default those assigned by coverage_fields without a memo
+        :return: the coverage value of the tokens that complete formulas have to cover and the mask of their coverage
+                fields, see coverage_mask, both are 0 if must_cover is False
         """
+        if not must_cover:
+            return 0, 0
+        if fields is None:
+            fields = coverage_fields(words)
+        return coverage_mask([word for word in words if word not in skippable and self.lexicon[word]], fields)
+
+
+    def derive(self, s, chart, alternatives, prune_equivalent=False, beam_width=None, best_first=False, deadline=None,
+               max_items=None, result=None, must_cover=False, skippable=(), prune_empty=False, max_insertions=None,
+               insertion_categories=None, packed=False, memo=None, context=None):
+        """
+        builds up all formulas for the input utterance, see gen for the parameters
+        the ParseItems are added to chart as soon as they are built, this is a generator to be able to use the complete
+        ParseItems before the parse is finished
+        :param s: string, the input utterance
+        :param chart: empty defaultdict(dict), filled with the chart of the parse mapping each pair of category and size
+                to a dictionary from the keys of the ParseItems to the ParseItems
+        :param alternatives: empty dictionary, filled for prune_equivalent with the keys of the representatives mapped
+                to the lists of the ParseItems collapsed into them and the keys of the other ParseItems mapped to their
+                other derivations
+        :param prune_equivalent: see gen
+        :param beam_width: see gen
+        :param best_first: if True, the agenda is ordered by score also without beam_width
+        :param deadline: see gen, only the time spent in the generator counts, not the time it is paused after a yield
+        :param max_items: see gen
+        :param result: ParseResult whose truncated flag is set if the parse is stopped by deadline or max_items and
+                whose pruned counts and stats are updated
+        :param must_cover: see gen
+        :param skippable: see gen
+        :param prune_empty: see gen
+        :param max_insertions: see gen
+        :param insertion_categories: see gen
+        :param packed: if True, the keys of the ParseItems contain the coverage instead of the multiset of the components,
+                so all derivations of the same formula from the same tokens are packed into one ParseItem in the chart,
+                the others are added to alternatives under the category and the key of that ParseItem (see ParseForest)
+        :param memo: None or a SubParseMemo, only with packed: the chart is seeded with the ParseItems of an earlier
+                parse that cover only tokens both utterances share and the combinations that this earlier parse already
+                made are not made again; the chart is added to the memo if the parse was not stopped
+        :param context: None for default_context or the EvaluationContext the ParseItems are evaluated in for
+                prune_equivalent and prune_empty
+        :return: generator that yields after each step a pair of the list of the new ParseItems of category "V" and the
+                highest score of the ParseItems on the agenda (None if the agenda is not ordered), and a last pair of
+                the complete ParseItems not yielded yet and None; with packed the new derivations of the complete
+                ParseItems in the chart and the seeded complete ParseItems are yielded as well
+        """
+        if result is None:
+            result = ParseResult()
+        if context is None:
+            context = default_context
+        # the time spent in the generator so far and the moment it was resumed the last time: the time of the parse and
+        # the deadline do not include the time the generator is paused, e.g. while stream evaluates the complete
+        # ParseItems or while the GUI waits for the user
+        spent = 0.0
+        resumed = time.perf_counter()
+        # the limits are checked before each formula taken from the agenda
+        n_items = 0
+
         # tokens of the input utterance
         words = s.split()
+        # coverage field, coverage value of each token and the masks to check whether two coverage values can be combined
+        fields = coverage_fields(words, memo)
+        word_coverages = {word: word_coverage(word, fields) for word in words}
+        bias, guard = coverage_limits(words, fields)
         # maximum length until which parser should build up formulas
         # set to length of input + 4 to account for potentially missing color and exist that has to be inserted "out of the air"
-        maxlen = len(words)+4
-        # initialize parse chart
-        chart = defaultdict(set)
+        # if the number of formulas inserted out of the air is limited, the max. length follows from that limit
+        if max_insertions is None:
+            maxlen = len(words)+4
+        else:
+            maxlen = len(words)+max_insertions
+        # the parse chart: each cell maps the keys of its ParseItems to the ParseItems so that it can be checked in
+        # constant time whether an item is already in the chart
+        # sizes of the non-empty chart cells for each category
+        chart_sizes = defaultdict(set)
         # agenda with all ParseItems that the parser has not tried to combine to any entry in the parse chart so far
-        agenda = []
+        # it is a queue, or a heap of (negated score, insertion number, ParseItem) entries if parsing best-first
+        best_first = best_first or beam_width is not None
+        # next is shadowed by the function of the grammar with the same name
+        insertions = count().__next__
+        if not best_first:
+            agenda = deque()
+            push = agenda.append
+            pop = agenda.popleft
+        else:
+            agenda = []
+            push = lambda p_item: heapq.heappush(agenda, (-score(p_item), insertions(), p_item))
+            pop = lambda: heapq.heappop(agenda)[2]
+        # for beam_width: heaps of (score, insertion number, key) entries of the ParseItems in each chart cell
+        cell_scores = defaultdict(list)
+        # for best_first: the tokens that can add a positive weight to a ParseItem that does not cover them yet, as
+        # triples of the offset of their coverage field, the number of their occurrences and their best lexical weight
+        field_mask = (1 << COVERAGE_FIELD_BITS) - 1
+        best_weights = []
+        for word in set(words):
+            best = max([weight for (categorie, function, weight) in self.lexicon[word]], default=0)
+            if best > 0:
+                best_weights.append((fields[word] * COVERAGE_FIELD_BITS, words.count(word), best))
+
+        # static pruning: ParseItems that cannot be part of a complete formula not exceeding the max. length are not
+        # built, see analyse_rules
+        lexical_categories = frozenset(categorie for word in words for (categorie, function, weight) in self.lexicon[word])
+        if lexical_categories not in self.goal_analyses:
+            air_categories = {categorie for (categorie, function, weight) in out_of_air}
+            self.goal_analyses[lexical_categories] = analyse_rules(self.rules, lexical_categories, air_categories)
+        min_to_goal, needed = self.goal_analyses[lexical_categories]
+        # max. size of a ParseItem of each category that can still be completed
+        size_limits = {categorie: maxlen - distance for categorie, distance in min_to_goal.items()}
+        # for each category of lexical ParseItems that is needed to complete some category, the tokens that have a
+        # lexical rule of this category as pairs of the offset of their coverage field and the number of occurrences
+        providers = {categorie: [(fields[word] * COVERAGE_FIELD_BITS, words.count(word)) for word in set(words)
+                                 if any(entry[0] == categorie for entry in self.lexicon[word])]
+                     for categorie in set().union(*needed.values())}
+
+        # for must_cover: the tokens that have to be covered as pairs of the offset of their coverage field and the number
+        # of their occurrences, a ParseItem with n of them uncovered needs at least n more lexical ParseItems
+        must_coverage, must_mask = self.must_cover_mask(words, must_cover, skippable, fields)
+        must_fields = [(fields[word] * COVERAGE_FIELD_BITS, words.count(word))
+                       for word in set(words) if must_mask & word_coverages[word]]
+        # ParseItems up to this size can always be completed, no matter which tokens they cover
+        must_limits = {categorie: maxlen - max(distance, sum(occurrences for shift, occurrences in must_fields))
+                       for categorie, distance in min_to_goal.items()}
+
+        def too_large(categorie, size, coverage):
+            """
+            :param categorie: string, category of a ParseItem
+            :param size: int, size of the ParseItem
+            :param coverage: int, coverage of the ParseItem
+            :return: True if the ParseItem cannot be completed to a formula covering all tokens of must_fields that
+                    does not exceed the max. length
+            """
+            uncovered = 0
+            for shift, occurrences in must_fields:
+                uncovered += occurrences - ((coverage >> shift) & field_mask)
+            return size + max(min_to_goal[categorie], uncovered) > maxlen
+
+        def completable(categorie, coverage):
+            """
+            :param categorie: string, category of a ParseItem
+            :param coverage: int, coverage of the ParseItem
+            :return: False if a category needed to complete the ParseItem can only come from covered tokens
+            """
+            for needed_categorie in needed[categorie]:
+                for shift, occurrences in providers[needed_categorie]:
+                    if (coverage >> shift) & field_mask < occurrences:
+                        break
+                else:
+                    return False
+            return True
+
+        def score(p_item):
+            """
+            :param p_item: ParseItem
+            :return: the weight of the ParseItem plus the best weights of the tokens it does not cover
+            """
+            estimate = p_item.summed_weights
+            for shift, occurrences, best in best_weights:
+                estimate += (occurrences - ((p_item.coverage >> shift) & field_mask)) * best
+            return estimate
+        # the key of each ParseItem is computed once so that duplicates can be found by hashing instead of comparing
+        # against every other item; it contains the multiset of the components packed into an int in the same way as
+        # the coverage: each pair of word and lexical rule of this parse gets a field that is wide enough to count up
+        # to maxlen occurrences, so the multiset of a combined ParseItem is the sum of the multisets of its parts
+        component_bits = maxlen.bit_length()
+        component_fields = {}
+        # for packed and prune_equivalent: the pairs of the keys of the ParseItems and the keys of the two ParseItems they
+        # are combined from
+        derivations = set()
+        # for max_insertions: the offsets of the coverage fields of the tokens, a ParseItem contains as many formulas
+        # built out of the air as its size exceeds the number of tokens it covers
+        word_shifts = [fields[word] * COVERAGE_FIELD_BITS for word in set(words)]
+
+        def air_items(p_item):
+            """
+            :param p_item: ParseItem
+            :return: the number of ParseItems built out of the air the ParseItem is combined from
+            """
+            return p_item.s - sum((p_item.coverage >> shift) & field_mask for shift in word_shifts)
+        # all formulas of this parse, with memo the formulas of all parses are stored in the same table so that the
+        # keys of the ParseItems of different parses can be compared
+        forms = FormulaTable() if memo is None else memo.forms
+        # for prune_equivalent: the ids of the denotations of the ParseItems (see signature), the representative
+        # ParseItem of each combination of category, size, coverage and denotation and the keys of the collapsed
+        # ParseItems mapped to their combination
+        signatures = {}
+        signature_ids = {}
+        representatives = {}
+        collapsed_keys = {}
+
+        # the complete ParseItems that have not been yielded yet
+        complete_items = []
+
+        # for memo: seed the chart with the ParseItems of the earlier parse that only cover tokens of the block, i.e.
+        # the tokens shared by both utterances, and that can still be completed in this parse
+        block = None
+        if memo is not None:
+            block = memo.block(self.lexicon, words, ForestCache.key(words, must_cover, skippable, max_insertions,
+                                                                   insertion_categories)[1:])
+        if block is not None:
+            block_words, block_chart, block_alternatives, block_limits, block_completable, block_too_large = block
+            block_bias, block_guard = coverage_limits(block_words, fields)
+            block_mask = coverage_mask(block_words, fields)[1]
+            # maps pairs of categories and coverage values to whether the earlier parse built all ParseItems of this
+            # category and coverage not exceeding its size limits: this is the case if they only cover tokens of the
+            # block and can be completed in the earlier parse, as a ParseItem can only be completed if all ParseItems
+            # it is built from can be completed (the same holds for block_too_large, which also depends on the size)
+            in_blocks = {}
+
+            def in_block(categorie, coverage):
+                """
+                :param categorie: string, category of a ParseItem
+                :param coverage: int, coverage of the ParseItem
+                :return: True if the earlier parse built all ParseItems with this category and coverage
+                """
+                if (categorie, coverage) not in in_blocks:
+                    in_blocks[categorie, coverage] = not coverage & ~block_mask and \
+                        not (coverage + block_bias) & block_guard and block_completable(categorie, coverage)
+                return in_blocks[categorie, coverage]
+
+            def seeded(p_item):
+                """
+                :param p_item: ParseItem of the earlier parse
+                :return: True if the ParseItem is built out of the air or was seeded
+                """
+                if p_item.leaf is not None and not p_item.leaf[0]:
+                    return True
+                return chart[p_item.c, p_item.s].get(p_item.key) is not None
+
+            # the cells are visited from the smallest to the largest size, so the children of a ParseItem are seeded
+            # before the ParseItem
+            for (categorie, size) in sorted(block_chart, key=lambda cell: cell[1]):
+                for item_key, item in block_chart[categorie, size].items():
+                    if not in_block(categorie, item.coverage) or size > size_limits.get(categorie, 0):
+                        continue
+                    if needed[categorie] and not completable(categorie, item.coverage):
+                        continue
+                    if must_fields and too_large(categorie, size, item.coverage):
+                        continue
+                    if max_insertions is not None and air_items(item) > max_insertions:
+                        continue
+                    # only the derivations whose children are seeded are kept
+                    derivations_kept = [derivation for derivation in
+                                        [item] + list(block_alternatives.get((categorie, item_key), ()))
+                                        if derivation.left is None or
+                                        (seeded(derivation.left) and seeded(derivation.right))]
+                    if not derivations_kept:
+                        continue
+                    for derivation in derivations_kept:
+                        if derivation.left is not None:
+                            derivations.add((categorie, item_key) + tuple(sorted([
+                                (derivation.left.c, derivation.left.key), (derivation.right.c, derivation.right.key)])))
+                    chart[categorie, size][item_key] = derivations_kept[0]
+                    if len(derivations_kept) > 1:
+                        alternatives[categorie, item_key] = derivations_kept[1:]
+                    chart_sizes[categorie].add(size)
+                    push(derivations_kept[0])
+                    if categorie == 'V' and item.coverage & must_mask == must_coverage:
+                        complete_items.extend(derivations_kept)
+                        result.stats.complete += 1
 
         # construct predicates according to tokens in the utterance
         # constructs a ParseItem for each input token and each lexical rule matching it according to the lexicon
         for word in words:
             for categorie, function, weight in self.lexicon[word]:
                 semantic = None
-                remaining = words.copy()
-                remaining.remove(word)
-                item = ParseItem(categorie, 1, semantic, [(word, function)], function, guessed_blocks, weight, remaining, [word])
-                chart[categorie, 1].add(item)
-                agenda.append(item)
-
-        # constructs predicates out of the air (i.e. with no corresponding token in the input utterance)
-        for (categorie, function, weight) in out_of_air:
-            remaining = words.copy()
-            item = ParseItem(categorie, 1, None, [("", function)], function, guessed_blocks, 0, remaining, [])
-            agenda.append(item)
+                leaf = (sys.intern(word), sys.intern(function))
+                component_fields.setdefault(leaf, len(component_fields))
+                form = forms.atom(leaf[1])
+                key = (form, word_coverages[word] if packed else 1 << (component_fields[leaf] * component_bits))
+                item = ParseItem(categorie, 1, semantic, None, None, forms, form, no_guesses, weight,
+                                 word_coverages[word], key, leaf)
+                # repeated tokens yield identical lexical items, only one of them is needed
+                if key in chart[categorie, 1]:
+                    continue
+                if size_limits.get(categorie, 0) < 1 or not completable(categorie, word_coverages[word]):
+                    continue
+                if must_fields and too_large(categorie, 1, word_coverages[word]):
+                    continue
+                chart[categorie, 1][key] = item
+                chart_sizes[categorie].add(1)
+                push(item)
+
+        # constructs predicates out of the air (i.e. with no corresponding token in the input utterance), in a fixed
+        # order so that a parse stopped by deadline or max_items does not depend on the order of the set
+        for (categorie, function, weight) in sorted(out_of_air):
+            if size_limits.get(categorie, 0) < 1 or max_insertions == 0:
+                continue
+            leaf = ("", sys.intern(function))
+            component_fields.setdefault(leaf, len(component_fields))
+            form = forms.atom(leaf[1])
+            key = (form, 0 if packed else 1 << (component_fields[leaf] * component_bits))
+            item = ParseItem(categorie, 1, None, None, None, forms, form, no_guesses, 0, 0, key, leaf)
+            push(item)
+
+        # for prune_empty: formulas denoting no blocks can only be part of a true formula if some number contains 0
+        if prune_empty:
+            numbers = [item for item in agenda if item.c == 'N'] if not best_first else \
+                [entry[2] for entry in agenda if entry[2].c == 'N']
+            if any(0 in self.denotation(item, context)[0] for item in numbers):
+                prune_empty = False
 
         # construct longer formulas bottom-up by combining the shorter ones based on the rules of the grammar:
-        maxlen_currently = 1
         # build up all possible formulas until no formula not exceeding the max. length is left
+        stats = result.stats
         while agenda:
+            if (max_items is not None and n_items >= max_items) or \
+                    (deadline is not None and spent + time.perf_counter() - resumed >= deadline):
+                result.truncated = True
+                break
             # take a not yet considered formula from the agenda
-            item = agenda.pop(0)
+            item = pop()
+            stats.pops += 1
+            # skip formulas that were removed from the chart by the beam or by prune_equivalent in the meantime
+            if item.left is not None and item.key not in chart[item.c, item.s]:
+                continue
             s1 = item.s
             c1 = item.c
-            components1 = item.components
-            new_items = set()
+            coverage1 = item.coverage
+            multiset1 = item.key[1]
+            new_items = []
+            # ParseItems built out of the air are never in the chart, so they are always taken from the agenda
+            inserted = item.leaf is not None and not item.leaf[0]
+            if max_insertions is not None:
+                insertions1 = air_items(item)
 
             # try if this formula can be combined with any other formula in the parse chart to yield a
             # new, longer formula in line with the grammar
-            for c2, s2 in chart:
-                s_new = s1+s2
-                if maxlen_currently < s_new:
-                    maxlen_currently = s_new
-
-                if (c2,c1) in self.rules:
-                     c_new = self.rules[c2, c1]
-                     # for each possible combination create a new ParseItem object for the resulting combined formula
-                     for item2 in chart[c2, s2]:
-                         # check that both ParseItems can be combined
-                         new_incl, new_rem = self.check_preconditions(item, item2, words)
-                         if not new_incl:
-                             continue
-
-                         semantic_new = None
-                         components_new = components1+item2.components
-                         function_new = item2.formular + "(" + item.formular + ")"
-                         weight_new = item.summed_weights + item2.summed_weights
-                         item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, guessed_blocks,
-                                              weight_new, new_rem, new_incl)
-                         # only add new ParseItem if its formula does not exceed the max size
-                         if s_new <= maxlen:
-                            # check that new ParseItem is not already on the agenda
-                            if not self.check_member(agenda, item_new):
-                                agenda.append(item_new)
-                         
-                            new_items.add(item_new)
-
-                if (c1,c2) in self.rules:
-                     c_new = self.rules[c1, c2]
-                     # for each possible combination create a new ParseItem object for the resulting combined formula
-                     for item2 in chart[c2, s2]:
-                         # check that both ParseItems can be combined
-                         new_incl, new_rem = self.check_preconditions(item, item2, words)
-                         if not new_incl:
-                             continue
-                         semantic_new = None
-                         components_new = components1+item2.components
-                         function_new = item.formular + "(" + item2.formular + ")"
-                         weight_new = item.summed_weights + item2.summed_weights
-                         item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, guessed_blocks,
-                                              weight_new, new_rem, new_incl)
-                         # only add new ParseItem if its formula does not exceed the max size
-                         if s_new <= maxlen:
-                            # check that new ParseItem is not already on the agenda
-                            if not self.check_member(agenda, item_new):
-                                agenda.append(item_new)
-                         
-                            new_items.add(item_new)
-
-            # add the newly built ParseItems to the chart
-            for new_item in new_items:
-                # check that only ParseItems that are not already in the chart are added
-                chart_list = list(chart[new_item.c, new_item.s].copy())
-                if not self.check_member(chart_list, new_item):
-                    chart[new_item.c,new_item.s].add(new_item)
-
+            # only the chart cells of categories that can be combined with c1 according to the rules are visited
+            for c2, functor_first, c_new in self.combinations[c1]:
+                if inserted and insertion_categories is not None and c2 not in insertion_categories:
+                    continue
+                for s2 in chart_sizes[c2]:
+                    s_new = s1+s2
+                    # only build new ParseItems whose formula does not exceed the max size and that can still be
+                    # completed to a formula of category V not exceeding the max size
+                    if s_new > size_limits.get(c_new, 0):
+                        continue
 
-        results = []
-        # keep track that ParseItems that represent the same formula built from the same components only occur once in the result
-        included_items = []
-        # out of all the formulas the parse built up, only return those that are complete, i.e. category = "V" and can
-        # be evaluated
-        for (c,s) in chart:
-            if c == 'V':
-                for item in chart[c,s]:
-                    # evaluate the formula
-                    item.semantic = self.sem(item)
-                    # store the guessed_blocks that were created during evaluation and reset for next formula
-                    item.guessed_blocks = guessed_blocks.copy()
-                    guessed_blocks.clear()
-                    # if average of weights should be computed for the total weight of a formula include the line below
-                    # item.summed_weights = item.summed_weights / item.s
-                    if self.check_member(included_items, item):
+                    cell2 = chart[c2, s2]
+                    stats.candidates += len(cell2)
+                    # for each possible combination create a new ParseItem object for the resulting combined formula
+                    for item2 in cell2.values():
+                        # check that both ParseItems can be combined, i.e. that together they cover at least one token
+                        # and no token more often than it occurs in the utterance
+                        coverage_new = coverage1 + item2.coverage
+                        if not coverage_new or (coverage_new + bias) & guard:
+                            continue
+                        # the earlier parse already made this combination if it only covers tokens of the block and
+                        # the earlier parse did not prune it, see in_block
+                        if block is not None and s_new <= block_limits.get(c_new, 0) and \
+                                in_block(c_new, coverage_new) and \
+                                (block_too_large is None or not block_too_large(c_new, s_new, coverage_new)):
+                            stats.memo_skipped += 1
+                            continue
+                        if needed[c_new] and not completable(c_new, coverage_new):
+                            continue
+                        if must_fields and s_new > must_limits[c_new] and too_large(c_new, s_new, coverage_new):
+                            continue
+                        if max_insertions is not None and insertions1 + air_items(item2) > max_insertions:
+                            continue
+
+                        semantic_new = None
+                        # the formula of the left child of the rule is applied to the formula of the right child
+                        if functor_first:
+                            function, argument = item.form, item2.form
+                        else:
+                            function, argument = item2.form, item.form
+                        # a commutative function is only applied to its second argument if the first one does not
+                        # come after it (see FormulaTable.after), so only one of f(a)(b) and f(b)(a) is built
+                        if forms.functors[function] in commutative_functions and \
+                                len(forms.arguments[function]) == 1 and \
+                                forms.after(forms.arguments[function][0], argument):
+                            continue
+                        form_new = forms.apply(function, argument)
+                        weight_new = item.summed_weights + item2.summed_weights
+                        if packed:
+                            key_new = (form_new, coverage_new)
+                        else:
+                            key_new = (form_new, multiset1 + item2.key[1])
+                        new_items.append(ParseItem(c_new, s_new, semantic_new, item, item2, forms, form_new,
+                                                   no_guesses, weight_new, coverage_new, key_new))
+
+            # add the newly built ParseItems to the chart and the agenda
+            # an item whose key is already in the chart has been put on the agenda before, so it is skipped entirely
+            stats.created += len(new_items)
+            for new_item in new_items:
+                cell = chart[new_item.c, new_item.s]
+                if packed or prune_equivalent:
+                    # the same derivation is built twice if both ParseItems were on the agenda at the same time
+                    derivation = (new_item.c, new_item.key) + tuple(sorted([(new_item.left.c, new_item.left.key),
+                                                                            (new_item.right.c, new_item.right.key)]))
+                    if derivation in derivations:
+                        stats.duplicates += 1
                         continue
-                    else:
-                        results.append(item)
-                        included_items.append(item)
+                    derivations.add(derivation)
+                if packed:
+                    # another derivation of a ParseItem in the chart becomes one of its hyperedges
+                    if new_item.key in cell:
+                        alternatives.setdefault((new_item.c, new_item.key), []).append(new_item)
+                        stats.duplicates += 1
+                        # it might have a higher weight than the derivations of a complete ParseItem yielded before,
+                        # see stream
+                        if new_item.c == 'V' and new_item.coverage & must_mask == must_coverage:
+                            complete_items.append(new_item)
+                        continue
+                if new_item.key in cell or new_item.key in collapsed_keys:
+                    stats.duplicates += 1
+                    if prune_equivalent:
+                        # the same formula built from the same components by a different split into two ParseItems
+                        # stands for the formulas built from the ParseItems collapsed into these as well, so it is
+                        # kept with the ParseItem in the chart or the representative it was collapsed into, see
+                        # expand_equivalents
+                        owner_key = new_item.key if new_item.key in cell else \
+                            representatives[collapsed_keys[new_item.key]].key
+                        alternatives.setdefault(owner_key, []).append(new_item)
+                    continue
+                if prune_empty and new_item.c in block_categories and not self.denotation(new_item, context)[0]:
+                    rule = (new_item.left.c, new_item.right.c)
+                    if rule not in self.rules:
+                        rule = (new_item.right.c, new_item.left.c)
+                    result.pruned[rule] += 1
+                    continue
+                if beam_width is not None:
+                    # prune the new item if the cell is full and its score is not higher than the lowest one in the cell
+                    new_score = score(new_item)
+                    scores = cell_scores[new_item.c, new_item.s]
+                    while scores and scores[0][2] not in cell:
+                        heapq.heappop(scores)
+                    if len(cell) >= beam_width and scores[0][0] >= new_score:
+                        continue
+                if prune_equivalent and new_item.c in equivalence_categories:
+                    # only ParseItems of the same size can be combined into the same larger ParseItems, as the size
+                    # limits, the max. length and max_insertions depend on the size
+                    equivalence = (new_item.c, new_item.s, new_item.coverage,
+                                   self.signature(new_item, signatures, signature_ids, context))
+                    representative = representatives.get(equivalence)
+                    # a representative that was removed from the chart by the beam is replaced by the new item
+                    if representative is not None and representative.key in chart[representative.c, representative.s]:
+                        if new_item.summed_weights <= representative.summed_weights:
+                            alternatives.setdefault(representative.key, []).append(new_item)
+                            collapsed_keys[new_item.key] = equivalence
+                            stats.duplicates += 1
+                            continue
+                        # the new item has a higher weight and replaces the representative in the chart, ParseItems
+                        # that were already combined from the old representative are kept
+                        del chart[representative.c, representative.s][representative.key]
+                        collapsed = alternatives.pop(representative.key, [])
+                        collapsed.append(representative)
+                        alternatives[new_item.key] = collapsed
+                        collapsed_keys[representative.key] = equivalence
+                    representatives[equivalence] = new_item
+                if beam_width is not None:
+                    if len(cell) >= beam_width:
+                        while scores[0][2] not in cell:
+                            heapq.heappop(scores)
+                        del cell[heapq.heappop(scores)[2]]
+                    heapq.heappush(scores, (new_score, insertions(), new_item.key))
+                cell[new_item.key] = new_item
+                chart_sizes[new_item.c].add(new_item.s)
+                push(new_item)
+                n_items += 1
+                if new_item.c == 'V' and new_item.coverage & must_mask == must_coverage:
+                    complete_items.append(new_item)
+                    stats.complete += 1
+
+            spent += time.perf_counter() - resumed
+            yield complete_items, (-agenda[0][0] if best_first and agenda else None)
+            resumed = time.perf_counter()
+            complete_items = []
+
+        stats.cells = {cell: len(items) for cell, items in chart.items() if items}
+        stats.parse_time += spent + time.perf_counter() - resumed
+        if memo is not None and not result.truncated:
+            memo.put(words, self.lexicon, ForestCache.key(words, must_cover, skippable, max_insertions,
+                                                          insertion_categories)[1:],
+                     (chart, alternatives, size_limits, completable, too_large if must_fields else None))
+        yield complete_items, None
+
+
+    def expand_equivalents(self, chart, items, alternatives, max_size, max_insertions):
+        """
+        recovers the formulas of a parse with prune_equivalent that are represented by its complete ParseItems: every
+        ParseItem combined from a representative stands for the ParseItems combined from the ParseItems collapsed into
+        it as well, recursively down to the lexical ParseItems, and every other derivation of the same formula from the
+        same components kept in the alternatives stands for the ParseItems combined from its own two ParseItems
+        :param chart: the chart of the parse
+        :param items: list of the complete ParseItems of the parse
+        :param alternatives: the alternatives of the parse, see derive
+        :param max_size: int, the max. size of the formulas
+        :param max_insertions: see gen
+        :return: list with the list of the other complete ParseItems represented by each of the items, none of them
+                built from the same formula and components as another one or one of the items
+        """
+        # the ParseItems that can be used interchangeably with each ParseItem of the chart or collapsed into one,
+        # including itself
+        equivalents = {}
+        for cell in chart.values():
+            for item in cell.values():
+                members = [item] + alternatives.get(item.key, [])
+                for member in members:
+                    equivalents[member.c, member.key] = members
+        # the ParseItems represented by each derivation of a ParseItem, including itself
+        represented = {}
+
+        def combine(categorie, left, right, functor_first):
+            """
+            :param categorie: string, category of the new ParseItem
+            :param left: ParseItem
+            :param right: ParseItem
+            :param functor_first: True if the formula of left is applied to the one of right
+            :return: the ParseItem combined from left and right as in derive, where a commutative function is only
+                    applied to its second argument if the first one comes first (see derive)
+            """
+            forms = left.forms
+            function_item, argument_item = (left, right) if functor_first else (right, left)
+            function, argument = function_item.form, argument_item.form
+            if forms.functors[function] in commutative_functions and len(forms.arguments[function]) == 1 and \
+                    forms.after(forms.arguments[function][0], argument):
+                # f(a)(b) is built as f(b)(a)
+                inner_first = forms.apply(function_item.left.form, function_item.right.form) == function
+                functor_item, first_item = (function_item.left, function_item.right) if inner_first else \
+                    (function_item.right, function_item.left)
+                return combine(categorie, combine(function_item.c, functor_item, argument_item, True), first_item,
+                               True)
+            form = forms.apply(function, argument)
+            return ParseItem(categorie, left.s + right.s, None, left, right, forms, form, no_guesses,
+                             left.summed_weights + right.summed_weights, left.coverage + right.coverage,
+                             (form, left.key[1] + right.key[1]))
+
+        def expand(item):
+            """
+            :param item: ParseItem
+            :return: list of the ParseItems represented by item
+            """
+            if item.leaf is not None:
+                return [item]
+            derivation = (item.c, item.key, item.left.c, item.left.key, item.right.c, item.right.key)
+            if derivation not in represented:
+                functor_first = item.forms.apply(item.left.form, item.right.form) == item.form
+                lefts = [left for member in equivalents.get((item.left.c, item.left.key), [item.left])
+                         for left in expand(member)]
+                rights = [right for member in equivalents.get((item.right.c, item.right.key), [item.right])
+                          for right in expand(member)]
+                represented[derivation] = [item if left is item.left and right is item.right else
+                                           combine(item.c, left, right, functor_first)
+                                           for left in lefts for right in rights]
+            return represented[derivation]
+
+        included_keys = {item.key for item in items}
+        expanded = []
+        for item in items:
+            item_alternatives = []
+            for member in [item] + alternatives.get(item.key, []):
+                for parse in expand(member):
+                    if parse.key in included_keys or parse.s > max_size:
+                        continue
+                    if max_insertions is not None and \
+                            sum(1 for leaf in parse.components if not leaf[0]) > max_insertions:
+                        continue
+                    item_alternatives.append(parse)
+                    included_keys.add(parse.key)
+            expanded.append(item_alternatives)
+        return expanded
 
-        return results
 
+    def signature(self, item, signatures, signature_ids, context):
+        """
+        computes an id of the denotation of a ParseItem w.r.t. the current picture such that ParseItems of the same
+        category and coverage with the same id can be used interchangeably in any larger formula
+        the denotation of a formula that evaluates to blocks, numbers or a truth value is its value together with the
+        blocks it adds to the back_tracks and the guessed blocks, formulas that evaluate to functions are identified by
+        the denotations of the two ParseItems they are combined from or by the formula itself if they are lexical
+        :param item: ParseItem
+        :param signatures: dictionary mapping the keys of the ParseItems to the ids of their denotations
+        :param signature_ids: dictionary mapping the denotations to their ids
+        :param context: the EvaluationContext the ParseItem is evaluated in
+        :return: int
+        """
+        signature_id = signatures.get(item.key)
+        if signature_id is None:
+            value, guesses, tracks = self.denotation(item, context)
+            if not callable(value):
+                if not isinstance(value, bool):
+                    value = frozenset(value)
+                denotation = (value, guesses, tracks)
+            elif item.leaf is not None:
+                denotation = item.form
+            else:
+                # the children are ordered by category since either of them might be the one taken from the agenda
+                children = sorted([(item.left.c, self.signature(item.left, signatures, signature_ids, context)),
+                                   (item.right.c, self.signature(item.right, signatures, signature_ids, context))])
+                denotation = tuple(children)
+            signature_id = signature_ids.setdefault(denotation, len(signature_ids))
+            signatures[item.key] = signature_id
+        return signature_id
+
+
+    def denotation(self, item, context):
+        """
+        evaluates the formula of a ParseItem w.r.t. the current picture and undoes the side effects of the evaluation
+        :param item: ParseItem
+        :param context: the EvaluationContext the formula is evaluated in
+        :return: tuple of the value of the formula, the frozenset of the guessed blocks or None if the formula does not
+                update the guessed blocks and a frozenset of pairs of a block and the frozenset of the blocks added to
+                its back_track
+        """
+        updates = context.guess_updates
+        value = self.sem(item, context)
+        guesses = None
+        if context.guess_updates != updates:
+            guesses = frozenset(context.guessed_blocks)
+        tracks = frozenset((b, frozenset(track)) for b, track in context.back_tracks.items() if track)
+        context.back_tracks.clear()
+        context.guessed_blocks.clear()
+        return value, guesses, tracks
+
+
+    def sem(self, lf, context=None):
+        """Interpret, as Python code, the root of a logical form
+        generated by this grammar."""
+        if context is None:
+            context = default_context
+        # Interpret semantics.
+        return self.compile(lf.forms, lf.form)(context)
 
-    def check_member(self, p_item_list, p_item):
-        """
-        checks for an ParseItem and a list of ParseItems whether there is already a ParseItem with the same formular and the same components in the list
-        :param p_item_list: a list of ParseItem objects
-        :param p_item: a ParseItem object
-        :return: True or False
-        """
-        for pi in p_item_list:
-            pi_c = pi.components.copy()
-            p_item_c = p_item.components.copy()
-            pi_c.sort()
-            p_item_c.sort()
-            if pi.formular == p_item.formular and pi_c == p_item_c:
-                return True
-        return False
-
-
-    def check_preconditions(self, pi_1, pi_2, words):
-        """
-        checks that no token from the input utterance is already in included in both parse items
-        if that is the case for one token they cannot be combined -> None, None is returned
-        if they do not both include the same token already, they can be combined and two lists are returned:
-        one with the included tokens and one with the remaining tokens of the combination of the two parse items
-        :param pi_1: a parse item
-        :param pi_2: a parse item
-        :param words: list of the input tokens
-        """
-        flag1 = False
-        flag2 = False
-
-        if len(pi_1.included_words) <= len(pi_2.remaining_words):
-            flag1 = True
-            temp_list = pi_2.remaining_words.copy()
-            for w in pi_1.included_words:
-                try:
-                    temp_list.remove(w)
-                except:
-                    flag1 = False
-
-        if len(pi_2.included_words) <= len(pi_1.remaining_words):
-            flag2 = True
-            temp_list = pi_1.remaining_words.copy()
-            for w in pi_2.included_words:
-                try:
-                    temp_list.remove(w)
-                except:
-                    flag2 = False
-
-        if flag1 and flag2:
-            new_included = pi_1.included_words + pi_2.included_words
-            new_remaining = words.copy()
-            for new in new_included:
-                new_remaining.remove(new)
-            return new_included, new_remaining
 
-        else:
-            return None, None
+    def compile(self, forms, node):
+        """
+        compiles a formula into a closure that evaluates it in the same order as eval would evaluate its string
+        representation: first the functor, then each argument followed by the application of the result so far to it
+        the closures of all subformulas are compiled only once and stored in forms.compiled
+        :param forms: the FormulaTable the formula is stored in
+        :param node: int, node id of the formula
+        :return: function of an EvaluationContext returning the value of the formula in this context
+        """
+        compiled = forms.compiled.get(node)
+        if compiled is None:
+            functor = self.compile_functor(forms.functors[node])
+            arguments = [self.compile(forms, a) for a in forms.arguments[node]]
+            if not arguments:
+                compiled = functor
+            elif len(arguments) == 1:
+                arg1, = arguments
+                compiled = lambda context: functor(context)(arg1(context))
+            elif len(arguments) == 2:
+                arg1, arg2 = arguments
+                compiled = lambda context: functor(context)(arg1(context))(arg2(context))
+            elif len(arguments) == 3:
+                arg1, arg2, arg3 = arguments
+                compiled = lambda context: functor(context)(arg1(context))(arg2(context))(arg3(context))
+            else:
+                def compiled(context):
+                    value = functor(context)
+                    for argument in arguments:
+                        value = value(argument(context))
+                    return value
+            compiled = self.memoize((forms, node), compiled)
+            forms.compiled[node] = compiled
+        return compiled
+
+
+    def memoize(self, key, evaluate):
+        """
+        wraps the closure of a formula such that the formula is evaluated only once w.r.t. the picture of a context
+        evaluating a formula has side effects: position_test adds blocks to the back_tracks of the context and
+        update_guess adds blocks to its guessed_blocks (and empties all back_tracks), so along with the value the blocks
+        added by the formula to the back_tracks and to guessed_blocks are stored in the denotations of the context and
+        are added again whenever the stored value is used
+        the effects of update_guess can only be replayed if no back_track contained any blocks before, this always
+        holds for complete formulas, otherwise the formula is just evaluated again
+        :param key: pair of the FormulaTable and the node id of the formula
+        :param evaluate: function of an EvaluationContext returning the value of the formula
+        :return: function of an EvaluationContext returning the value of the formula
+        """
+        def memoized(context):
+            back_tracks = context.back_tracks
+            guessed_blocks = context.guessed_blocks
+            entry = context.denotations.get(key)
+            if entry is not None:
+                value, guesses, tracks = entry
+                if guesses is None or not any(back_tracks.values()):
+                    if guesses is not None:
+                        # replaying the effects counts as an update so that enclosing formulas record them as well
+                        context.guess_updates += 1
+                        guessed_blocks.update(guesses)
+                    for b, track in tracks:
+                        back_tracks.setdefault(b, []).extend(track)
+                    return value
+
+            updates = context.guess_updates
+            lengths = {b: len(track) for b, track in back_tracks.items()}
+            # collect the guessed blocks of this formula separately from those of the enclosing formula
+            outer_guesses = set(guessed_blocks)
+            guessed_blocks.clear()
+            value = evaluate(context)
+            guesses = None
+            if context.guess_updates != updates:
+                guesses = frozenset(guessed_blocks)
+            guessed_blocks.update(outer_guesses)
+
+            if guesses is None or not any(lengths.values()):
+                tracks = [(b, track[lengths.get(b, 0):]) for b, track in back_tracks.items()
+                          if len(track) > lengths.get(b, 0)]
+                context.denotations[key] = (value, guesses, tracks)
+            return value
+        return memoized
+
+
+    def compile_functor(self, functor):
+        """
+        compiles the logical form of a lexical rule, e.g. "red" or "block_filter([], allblocks)", once into a closure
+        the functions of self.functions take the context as argument, logical forms that only use builtins such as
+        "range(1,17)" are evaluated at compile time, all others are evaluated when the closure is called as they depend
+        on the picture, allblocks in them refers to the blocks of the context
+        :param functor: string, logical form of a lexical rule
+        :return: function of an EvaluationContext returning the value of the logical form
+        """
+        compiled = self.compiled_functors.get(functor)
+        if compiled is None:
+            if functor in self.functions:
+                compiled = self.functions[functor]
+            else:
+                code = compile(functor, "<lexicon>", "eval")
+                if all(hasattr(builtins, name) for name in code.co_names):
+                    value = eval(code, globals())
+                    compiled = lambda context: value
+                else:
+                    evaluate = eval("lambda allblocks: " + functor, globals())
+                    compiled = lambda context: evaluate(context.blocks)
+            self.compiled_functors[functor] = compiled
+        return compiled
+
+
+def init_evaluation(blocks, tables):
+    """
+    sets the picture and the FormulaTables in a process of Grammar.evaluate_all
+    :param blocks: list of the Block objects of the current picture
+    :param tables: list of FormulaTables
+    :return: None
+    """
+    global evaluation_grammar, evaluation_context
+    evaluation_context = EvaluationContext()
+    evaluation_context.blocks.extend(blocks)
+    evaluation_grammar = Grammar({}, rules, functions)
+    evaluation_tables[:] = tables
 
 
-    def sem(self, lf):
-        """Interpret, as Python code, the root of a logical form
-        generated by this grammar."""
-        # Import all of the user's functions into the namespace to
-        # help with the interpretation of the logical forms.
-        grammar = sys.modules[__name__]
-        for key, val in list(self.functions.items()):
-            setattr(grammar, key, val)
-        # Interpret semantics.
-        return eval(lf.formular)
+def evaluate_part(formulas):
+    """
+    evaluates formulas w.r.t. the picture in a process of Grammar.evaluate_all, the same way as Grammar.evaluate
+    :param formulas: list of pairs of the index of a FormulaTable and the node id of a complete formula
+    :return: list of pairs of the value and the indices of the guessed blocks in the blocks of the picture of each
+            formula
+    """
+    guessed_blocks = evaluation_context.guessed_blocks
+    block_ids = {id(b): i for i, b in enumerate(evaluation_context.blocks)}
+    denoted = []
+    for table_id, form in formulas:
+        semantic = evaluation_grammar.compile(evaluation_tables[table_id], form)(evaluation_context)
+        denoted.append((semantic, [block_ids[id(b)] for b in guessed_blocks]))
+        guessed_blocks.clear()
+    return denoted
 
 
 # The lexica for our pictures
@@ -336,7 +2077,7 @@ class Grammar:
 # gold_lexicon_basic consists of the basic lexical rules needed from first level on
 gold_lexicon_basic = {
     'form':[('B', 'block_filter([], allblocks)', 1)],
-    'forms':[('B', 'block_filter([], allblocks)')],
+    'forms':[('B', 'block_filter([], allblocks)', 1)],
     'square': [('B', 'block_filter([lambda b: b.shape=="rectangle"], allblocks)', 1)],
     'squares': [('B', 'block_filter([lambda b: b.shape=="rectangle"], allblocks)', 1)],
     'triangle': [('B', 'block_filter([(lambda b: b.shape == "triangle")], allblocks)', 1)],
@@ -388,27 +2129,113 @@ rules = {
 
 }
 
-# The functions that are used to interpret our logical forms with eval.
-# They are imported into the namespace Grammar.sem to achieve that.
+def analyse_rules(rules, lexical_categories, air_categories):
+    """
+    computes for each category how a ParseItem of this category can be completed to a ParseItem of category V
+    the min. size of the formulas of each category and the categories of the lexical ParseItems that every formula of
+    a category contains are computed first, ParseItems of the categories in air_categories can be built out of the air
+    and are not needed to be lexical
+    :param rules: dictionary with pairs of child categories as keys and the parent category as value
+    :param lexical_categories: set of the categories of the lexical ParseItems
+    :param air_categories: set of the categories of the ParseItems built out of the air
+    :return: a pair of dictionaries, both only contain the categories that can be part of a formula of category V:
+            min_to_goal maps each category to the min. size that has to be added to a ParseItem of the category to
+            build a ParseItem of category V and needed maps it to the set of the categories of the lexical ParseItems
+            that are part of any such ParseItem of category V but not of the ParseItem itself
+    """
+    infinity = float("inf")
+    # min. size of the formulas of each category and the categories of the lexical ParseItems they all contain,
+    # None if no formula of the category has been found yet
+    min_size = defaultdict(lambda: infinity)
+    required = defaultdict(lambda: None)
+    for categorie in lexical_categories | air_categories:
+        min_size[categorie] = 1
+        required[categorie] = frozenset() if categorie in air_categories else frozenset([categorie])
+    changed = True
+    while changed:
+        changed = False
+        for (left, right), parent in rules.items():
+            if required[left] is None or required[right] is None:
+                continue
+            size = min_size[left] + min_size[right]
+            categories = required[left] | required[right]
+            if required[parent] is not None:
+                categories &= required[parent]
+            if size < min_size[parent] or categories != required[parent]:
+                min_size[parent] = min(size, min_size[parent])
+                required[parent] = categories
+                changed = True
+
+    # the same for the parts that complete a ParseItem of each category to a ParseItem of category V
+    min_to_goal = {'V': 0}
+    needed = {'V': frozenset()}
+    changed = True
+    while changed:
+        changed = False
+        for (left, right), parent in rules.items():
+            if parent not in min_to_goal:
+                continue
+            for child, partner in ((left, right), (right, left)):
+                if required[partner] is None:
+                    continue
+                distance = min_to_goal[parent] + min_size[partner]
+                categories = needed[parent] | required[partner]
+                if child in needed:
+                    categories &= needed[child]
+                if distance < min_to_goal.get(child, infinity) or categories != needed.get(child):
+                    min_to_goal[child] = min(distance, min_to_goal.get(child, infinity))
+                    needed[child] = categories
+                    changed = True
+    return min_to_goal, needed
+
+
+# categories of the ParseItems that are collapsed if they have the same size, coverage and denotation when parsing
+# with Grammar.gen(s, prune_equivalent=True)
+equivalence_categories = {'BC', 'BS', 'EN', 'V'}
+
+# categories of the combined ParseItems whose formulas denote lists of blocks, they are dropped if the list is empty
+# when parsing with Grammar.gen(s, prune_empty=True)
+block_categories = {'BC', 'BS'}
+
+def index_rules(rules):
+    """
+    compiles the binarized rule dictionary into an index from a category to all categories it can be combined with
+    :param rules: dictionary with pairs of child categories as keys and the parent category as value
+    :return: a dictionary mapping each category c to a list of triples (partner category, functor_first, parent category)
+            where functor_first is True if c is the left child of the rule, i.e. the formula of category c is applied
+            to the formula of the partner category, and False if c is the right child
+    """
+    combinations = defaultdict(list)
+    for (left, right), parent in rules.items():
+        combinations[left].append((right, True, parent))
+        combinations[right].append((left, False, parent))
+    return combinations
+
+
+# The functions that are used to interpret our logical forms.
+# Each of them takes the EvaluationContext the logical form is evaluated in and returns the function it denotes.
 functions = {
-    'exist': (lambda n: (lambda b: update_guess(b) and len(b) in n)),
-    'und': (lambda v1: (lambda v2: v1 and v2)),
-    'oder': (lambda v1: (lambda v2: v1 or v2)),
-    'xoder': (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1))),
-
-    'blue': (lambda x: block_filter([(lambda b:b.colour == "blue")], x)),
-    'red': (lambda x: block_filter([(lambda b:b.colour == "red")], x)),
-    'green': (lambda x: block_filter([(lambda b:b.colour == "green")], x)),
-    'yellow':(lambda x: block_filter([(lambda b:b.colour == "yellow")], x)),
-    'anycol':(lambda x: block_filter([], x)),
-
-    'under': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "u")))),
-    'over': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "o")))),
-    'next': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "n")))),
-    'left': (lambda n: (lambda x: (lambda y:position_test(y, x, n, "l")))),
-    'right': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "r"))))
+    'exist': (lambda context: (lambda n: (lambda b: update_guess(b, context) and len(b) in n))),
+    'und': (lambda context: (lambda v1: (lambda v2: v1 and v2))),
+    'oder': (lambda context: (lambda v1: (lambda v2: v1 or v2))),
+    'xoder': (lambda context: (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1)))),
+
+    'blue': (lambda context: (lambda x: block_filter([(lambda b:b.colour == "blue")], x))),
+    'red': (lambda context: (lambda x: block_filter([(lambda b:b.colour == "red")], x))),
+    'green': (lambda context: (lambda x: block_filter([(lambda b:b.colour == "green")], x))),
+    'yellow':(lambda context: (lambda x: block_filter([(lambda b:b.colour == "yellow")], x))),
+    'anycol':(lambda context: (lambda x: block_filter([], x))),
+
+    'under': (lambda context: (lambda n: (lambda x: (lambda y: position_test(y, x, n, "u", context))))),
+    'over': (lambda context: (lambda n: (lambda x: (lambda y: position_test(y, x, n, "o", context))))),
+    'next': (lambda context: (lambda n: (lambda x: (lambda y: position_test(y, x, n, "n", context))))),
+    'left': (lambda context: (lambda n: (lambda x: (lambda y:position_test(y, x, n, "l", context))))),
+    'right': (lambda context: (lambda n: (lambda x: (lambda y: position_test(y, x, n, "r", context)))))
 }
 
+# The functions from functions with two arguments whose order does not matter, the parser builds them only in one order
+commutative_functions = {'und', 'oder', 'xoder'}
+
 
 
 def grouping(lfs):
@@ -422,6 +2249,7 @@ def grouping(lfs):
             and a list of all possible guessed blocks combinations ordered by the max weight of a corresponding formula
             in descending order
     """
+    start = time.perf_counter()
     groups = defaultdict(list)
     max_weights = []
     for lf in lfs:
@@ -436,6 +2264,8 @@ def grouping(lfs):
     max_weights.sort(key=lambda  tuple: tuple[1], reverse=True)
     sorted_guesses = [gue_bl for (gue_bl, weight) in max_weights]
 
+    if isinstance(lfs, ParseResult):
+        lfs.stats.grouping_time += time.perf_counter() - start
     return groups, sorted_guesses
 
 
@@ -448,13 +2278,7 @@ if __name__ == "__main__":
     """
     gold_lexicon = gold_lexicon_basic.copy()
     gram = Grammar(gold_lexicon, rules, functions)
-    allblocks2 = []
-    all_blocks_grid = allblocks_test.copy()
-    for row in allblocks_test:
-        for blo in row:
-            if blo:
-                allblocks2.append(blo)
-    allblocks = allblocks2
+    default_context.set_grid(allblocks_test)
 
     #lfs = gram.gen("a red triangle and a green square")
     #lfs = gram.gen("is one red triangle over a blue triangle")
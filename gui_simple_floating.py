@@ -21,6 +21,17 @@ crude_rule = create_lex_rules()
 threshold = -0.1
 upper_threshold = 1.0
 total_scores = defaultdict(lambda:defaultdict(int))
+# number of seconds after which the parser stops and only the parses found so far are used
+parse_deadline = 60
+# None to learn from all parses, or the number of groups of parses with the same guessed blocks the learning algorithm
+# learns from, the best ones are taken from a packed parse forest without building the other parses
+forest_groups = None
+# None or the max. number of parses taken from each of these groups
+forest_trees = None
+# the parse forests of the last descriptions, a repeated description is only evaluated w.r.t. the new picture
+forest_cache = ForestCache()
+# the charts of the last parses, the parse of a new description starts from the parts it shares with them
+parse_memo = SubParseMemo()
 
 # initializing the windows
 start = sg.Window("Hello!", layout_starting_screen)
@@ -116,6 +127,8 @@ while True:
         os.mkdir(session_name)
         evaluation_file = "./" + session_name + "/evaluation.csv"
         weights_file = "./" + session_name + "/weights.csv"
+        # the counters of each parse are appended as JSON lines, see ParseStats
+        stats_file = "./" + session_name + "/parse_stats.jsonl"
         rule_probs = dict()
         learning = defaultdict(int)
         with open(evaluation_file, "w", encoding="utf-8") as f:
@@ -169,21 +182,29 @@ while True:
         gram = Grammar(crude_lexicon,rules,functions)
         print("checkpoint")
 
-        # generate all possible parses given the current rules
-        parse = gram.gen(inpt)
-        print("parsing done")
-
-        # with grouping included every marking will only appear once
-        groups, sortedguesses = grouping(parse)
-        print(sortedguesses)
+        # a repeated description is taken from the cache and only evaluated w.r.t. the current picture
+        if forest_cache.contains(crude_lexicon, inpt):
+            forest = gram.forest(inpt, cache=forest_cache)
+            parse = None
+            guesses = forest.guesses()
+        # otherwise generate the possible parses given the current rules lazily, best parses first, so that the first
+        # guess can be shown before all parses are found; parse is filled with the parses found so far and gets the
+        # packed forest of the parse when it is finished, which is kept in the cache for repeated descriptions
+        else:
+            forest = None
+            parse = ParseResult()
+            guesses = gram.stream_guesses(inpt, parse, deadline=parse_deadline, packed=True, cache=forest_cache,
+                                          memo=parse_memo)
+        print("parsing started")
 
         # creates an iterator for the user to move forward and backward through the guesses
-        blocks = BackAndForth_Iterator(sortedguesses)
+        # the guesses are ordered as by grouping and every marking will only appear once
+        blocks = BackAndForth_Iterator(guesses)
         print(blocks)
         try:
             current_marking = blocks.next()
             guess = []
-            for b in groups[current_marking][0].guessed_blocks:
+            for b in current_marking:
                 guess.append((b.y, b.x))
             print(guess)
             current_pic.mark(guess)
@@ -200,9 +221,25 @@ while True:
         hiding_unhiding(event)
         n_deleted_rules = 0
         deleted_rules = list()
+        if forest is None:
+            # finish the parse of the stream, the forest contains all guesses shown so far even if it was stopped
+            blocks.all()
+            forest = parse.forest
+            print("parsing done" + (" (stopped after " + str(parse_deadline) + " seconds)" if forest.truncated else ""))
+        if forest_groups is None:
+            # the learning algorithm needs all parses
+            classes = forest.parses()
+            lf = forest.group(current_marking)
+        else:
+            # only build the parses of the best groups and of the confirmed guess
+            groups, sortedguesses = forest.groups(forest_groups, forest_trees)
+            lf = forest.group(current_marking, forest_trees)
+            classes = [p_item for group in groups.values() for p_item in group]
+            if current_marking not in groups:
+                classes += lf
+        forest.stats.dump(stats_file, level=level, n_pic=i_picture, input=inpt)
         # updates weights
-        lf = groups[current_marking]
-        weights = evaluate_semparse(inpt,lf,gram,parse)
+        weights = evaluate_semparse(inpt,lf,gram,classes)
         if all([weights[key]==0 for key in weights]):
             print("Works!") # if there is only the correct mapping left
             word_rule = defaultdict(set)
@@ -212,9 +249,14 @@ while True:
                     word_rule[word].add(rule)
             for word in word_rule:
                 if word in crude_lexicon:
+                    removed = set()
                     for categorie,rule,prob in crude_lexicon[word][:]:
                         if not rule in word_rule[word]:
                             crude_lexicon[word].remove((categorie,rule,prob))
+                            removed.add(rule)
+                    # only the cached parse forests with this word are pruned
+                    if removed:
+                        forest_cache.remove_rules(word, removed, crude_lexicon)
                     
                     
         else:
@@ -233,6 +275,7 @@ while True:
                         for r in crude_lexicon[word][:]:
                             if r[1] == rule:
                                 crude_lexicon[word].remove(r)
+                        forest_cache.remove_rules(word, {rule}, crude_lexicon)
 
             # delete rules with weight equal or below 0 if one rule for a word reaches weight of 1
             rules_to_delete = set()
@@ -257,6 +300,7 @@ while True:
                 for r in crude_lexicon[word][:]:
                     if r[1] == rule:
                         crude_lexicon[word].remove(r)
+                forest_cache.remove_rules(word, {rule}, crude_lexicon)
 
             # update crude lexicon
             for word in crude_lexicon:
@@ -351,7 +395,7 @@ while True:
         try:
             current_marking = blocks.next()
             guess = []
-            for b in groups[current_marking][0].guessed_blocks:
+            for b in current_marking:
                 guess.append((b.y, b.x))
             print(guess)
             current_pic.mark(guess)
@@ -381,7 +425,7 @@ while True:
             current_marking = blocks.previous()
             guess = []
             #print("GUESSEDBLOCKS", lf.guessed_blocks)
-            for b in groups[current_marking][0].guessed_blocks:
+            for b in current_marking:
                 guess.append((b.y, b.x))
             current_pic.mark(guess)
             window["-IMAGE-"].update(filename=picture_path(level, i_picture, session_name, guess=True))
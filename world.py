@@ -16,7 +16,6 @@ class Block:
         self.shape = shape
         self.x = None
         self.y = None
-        self.back_track = []
 
     def set_coordinates(self, x, y):
         """
@@ -35,9 +34,6 @@ class Block:
         s = self.shape + ": " + self.colour
         return s
 
-    def keep_track(self, block):
-        self.back_track.append(block)
-
 
 def set_all_coordinates(chart):
     for row in range(1,len(chart)+1):